@@ -1,31 +1,148 @@
+import argparse
+import heapq
+import json
 import math
+import multiprocessing
+import os
+import queue
 import random
+import shutil
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 import matplotlib.offsetbox as offsetbox
-from itertools import product
+from matplotlib.collections import EllipseCollection
+from itertools import chain, product
+from multiprocessing import shared_memory
 import time
 
 _empty_set = set()
 radius = 0.01
 
+# Time to visit an empty cell in the dense scan relative to testing one candidate pair
+_cell_cost = 0.3
 
+
+# Sort-based cell list, returns every unordered pair (i < j) of particles that share
+# or neighbour a cell while only touching the occupied cells
+def cell_pairs(keys):
+    keys = np.asarray(keys, dtype=np.int64)
+    if len(keys) < 2:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+
+    # Linearise the cells, padded by one so neighbouring offsets never wrap around
+    keys = keys - keys.min(axis=0) + 1
+    extent = keys.max(axis=0) + 2
+    strides = np.concatenate([np.cumprod(extent[::-1])[-2::-1], [1]])
+    ids = keys @ strides
+
+    order = np.argsort(ids, kind="stable")
+    sorted_ids = ids[order]
+    rank = np.arange(len(ids))
+
+    # Only the forward half of the neighbours is visited, so each pair appears once
+    offsets = np.array(list(product(*[range(-1, 2) for i in range(keys.shape[1])]))) @ strides
+    offsets = offsets[offsets > 0]
+
+    first, second = [], []
+    for offset in np.concatenate([[0], offsets]):
+        if offset == 0:
+            starts = rank + 1
+        else:
+            starts = np.searchsorted(sorted_ids, sorted_ids + offset, side="left")
+        ends = np.searchsorted(sorted_ids, sorted_ids + offset, side="right")
+        counts = np.maximum(ends - starts, 0)
+
+        total = counts.sum()
+        if total == 0:
+            continue
+        inner = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        first.append(np.repeat(order, counts))
+        second.append(order[np.repeat(starts, counts) + inner])
+
+    if not first:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+    first = np.concatenate(first)
+    second = np.concatenate(second)
+    return np.minimum(first, second), np.maximum(first, second)
+
+
+def add_timings(timings, **phases):
+    for phase, value in phases.items():
+        timings[phase] = timings.get(phase, 0.0) + value
+
+
+# With num=None the grid sizes its own cells from the particles and re-tunes them every
+# retune_every steps when the ideal cell size has moved by more than retune_factor
 class Grid:
-    def __init__(self, volume, num):
+    def __init__(self, volume, num=None, search="dense", retune_every=100, retune_factor=1.5):
         self.grid = {}
         self.bucket_map = {}
-        self.separation = np.array([(i[1]-i[0]) / num for i in volume])
+        self.search = search
+        self.timings = None
         self.volume = volume
+        self.auto = num is None
+        self.retune_every = retune_every
+        self.retune_factor = retune_factor
+        self.steps = 0
+        self.set_cells(1 if num is None else num)
+
+    def set_cells(self, num):
+        volume = self.volume
+        self.num = num
+        self.separation = np.array([(i[1]-i[0]) / num for i in volume])
         self.dim = len(volume)
         if self.dim < 2:
-            self.start = [int(volume[0][0] // self.separation), 0]
-            self.end = [int((volume[0][1] + 1) // self.separation), 1]
+            self.start = [int(volume[0][0] // self.separation[0]), 0]
+            self.end = [int((volume[0][1] + 1) // self.separation[0]), 1]
             self.dim = 2
         else:
             self.start = [int(boundary[0] // self.separation[i]) for i, boundary in enumerate(volume)]
             self.end = [int((boundary[1] + 1) // self.separation[i]) for i, boundary in enumerate(volume)]
 
+        particles = list(self.bucket_map)
+        self.grid = {}
+        self.bucket_map = {}
+        for particle in particles:
+            self.add_particle(particle)
+
+    def interaction_diameter(self):
+        return 2 * max(particle.radius for particle in self.bucket_map)
+
+    # The dense scan costs one visit per cell plus one test per candidate pair. For a cell size h
+    # the cells cost V / h^dim and the pairs about 3^dim sum(n_c (n_c - 1)) for the occupancy n_c of each
+    # cell, which is measured on the current positions so dense clouds are seen as dense. The
+    # cheapest h is picked from a geometric range starting at the largest interaction diameter,
+    # below which collisions would be missed. The sorted search never visits empty cells so its
+    # best h is the diameter itself
+    def cell_size(self, candidates=24):
+        diameter = self.interaction_diameter()
+        if self.search == "sorted":
+            return diameter
+
+        dim = len(self.volume)
+        extents = [i[1] - i[0] for i in self.volume]
+        positions = np.array([particle.position[:dim] for particle in self.bucket_map])
+
+        best, best_cost = diameter, np.inf
+        for size in diameter * np.geomspace(1, max(max(extents) / diameter, 1), candidates):
+            _, counts = np.unique(np.floor(positions / size), axis=0, return_counts=True)
+            cost = _cell_cost * math.prod(extents) / size ** dim + 3 ** dim * np.sum(counts * (counts - 1))
+            if cost < best_cost:
+                best, best_cost = size, cost
+        return best
+
+    def tune(self):
+        if not self.bucket_map:
+            return
+
+        size = self.cell_size()
+        current = min(self.separation)
+        if current < self.interaction_diameter() or not 1 / self.retune_factor < size / current < self.retune_factor:
+            num = max(1, int(min(i[1] - i[0] for i in self.volume) // size))
+            if num != self.num:
+                self.set_cells(num)
+
     def key(self, particle):
         return tuple(particle.position // self.separation)
 
@@ -53,39 +170,85 @@ class Grid:
         self.grid = {k: v for k, v in self.grid.items() if v != _empty_set}
         self.bucket_map = {k: v for k, v in self.bucket_map.items() if k != _empty_set}
 
-    def update(self, dt):
-
+    def dense_pairs(self):
+        pairs = []
         for index in product(*[range(start, end) for start, end in zip(self.start, self.end)]):
             for particle in self.grid.get(index, _empty_set):
 
                 for i in product(*[range(-1, 2) for i in range(self.dim)]):
                     for particle2 in self.grid.get(tuple(np.array(index) + np.array(i)), _empty_set):
                         if particle2 != particle:
-                            particle.collide(particle2)
+                            pairs.append((particle, particle2))
+        return pairs
+
+    def sorted_pairs(self):
+        particles = list(self.bucket_map)
+        if not particles:
+            return []
 
+        first, second = cell_pairs([particle.key for particle in particles])
+        return [(particles[i], particles[j]) for i, j in zip(first, second)]
 
+    # When self.timings is a dict the time spent in every phase of the step is added to it
+    def update(self, dt):
+        if self.auto and self.steps % self.retune_every == 0:
+            self.tune()
+        self.steps += 1
+
+        start = time.perf_counter()
+        if self.search == "sorted":
+            pairs = self.sorted_pairs()
+        else:
+            pairs = self.dense_pairs()
+        searched = time.perf_counter()
+
+        # The sorted search gives every pair once, the dense scan gives it from both sides
+        if self.search == "sorted":
+            for particle, particle2 in pairs:
+                particle.collide_pair(particle2)
+        else:
+            for particle, particle2 in pairs:
+                particle.collide(particle2)
+        collided = time.perf_counter()
+
+        # A wall hit reverses the normal velocity, so the wall takes 2 m |v_n| as the other engines count it
         momentum = 0
         for particle in self.bucket_map:
             particle.update(dt)
-            momentum += particle.walls() * particle.mass * np.linalg.norm(particle.velocity)
+            velocity = particle.velocity.copy()
+            particle.walls()
+            momentum += particle.mass * float(np.sum(np.abs(particle.velocity - velocity)))
+        walled = time.perf_counter()
 
         for particle, _ in self.bucket_map.items():
             self.update_particle(particle)
 
         self.update_grid()
 
+        if self.timings is not None:
+            add_timings(self.timings, search=searched - start, collisions=collided - searched,
+                        walls=walled - collided, rebucket=time.perf_counter() - walled)
+
         return momentum
 
     def get_particles(self):
         for i in self.bucket_map:
             yield i
 
+    def __len__(self):
+        return len(self.bucket_map)
+
+    def kinetic_energy(self):
+        return sum(0.5 * particle.mass * np.dot(particle.velocity, particle.velocity) for particle in self.bucket_map)
+
 
 def hypot(*array):
     if len(array) == 1:
         return abs(array[0])
-    else:
+    elif len(array) == 2:
         return np.hypot(*array)
+    else:
+        return math.sqrt(sum(i ** 2 for i in array))
 
 
 class Particle:
@@ -94,9 +257,11 @@ class Particle:
         self.mass = mass
 
         v = math.sqrt(3 * 8.317162 * ini_temp / self.mass)
-        theta = random.uniform(-np.pi, np.pi)
-        rot = np.array([[np.cos(theta), -np.sin(theta)], [np.sin(theta), np.cos(theta)]])
-        self.velocity = np.dot(rot, np.array([random.randrange(int(v*0.7), int(v*1.3)) for i in ini_volume]))
+        self.velocity = np.array([random.randrange(int(v*0.7), int(v*1.3)) for i in ini_volume], dtype=float)
+        if len(ini_volume) == 2:
+            theta = random.uniform(-np.pi, np.pi)
+            rot = np.array([[np.cos(theta), -np.sin(theta)], [np.sin(theta), np.cos(theta)]])
+            self.velocity = np.dot(rot, self.velocity)
 
         if self.position.size < 2:
             self.position = np.array([self.position[0], 0])
@@ -133,57 +298,833 @@ class Particle:
 
         self.velocity = ((self.mass - particle.mass) * v1 + (2 * particle.mass) * v2) / M
 
+    # Both sides of a collision at once, for searches that give every pair only once
+    def collide_pair(self, particle):
+        if hypot(*(self.position - particle.position)) > self.radius + particle.radius:
+            return
 
-temp = 200
-volume = [(-10.0, 10.0), (-10.0, 10.0)]
-grid = Grid(volume, 10 / 0.1)
+        M = self.mass + particle.mass
+        v1 = self.previous_velocity
+        v2 = particle.previous_velocity
 
-for i in range(100):
-    particle = Particle(volume, temp, 1)
-    grid.add_particle(particle)
+        self.velocity = ((self.mass - particle.mass) * v1 + (2 * particle.mass) * v2) / M
+        particle.velocity = ((particle.mass - self.mass) * v2 + (2 * self.mass) * v1) / M
 
-for i in range(500):
-    particle = Particle([(-1, 1), (-1, 1)], temp * 3, 0.4)
-    particle.space = volume
-    grid.add_particle(particle)
 
-fig, ax = plt.subplots()
-ax.set(xlim=[volume[0][0], volume[0][1]], ylim=[-10, 10])
+# Structure-of-arrays engine, every particle is a row in contiguous (N, dim) arrays
+# so drift, walls and collisions run as one numpy operation over the whole population
+class ParticleArrays:
+    def __init__(self, volume, num):
+        self.volume = volume
+        self.num = num
+        self.dim = max(len(volume), 2)
+        self.separation = np.array([(i[1]-i[0]) / num for i in volume])
+        if len(volume) < 2:
+            self.separation = np.append(self.separation, self.separation[0])
 
-text = offsetbox.AnchoredText("0", loc=1)
-ax.add_artist(text)
+        self.positions = np.empty((0, self.dim))
+        self.velocities = np.empty((0, self.dim))
+        self.previous_velocities = np.empty((0, self.dim))
+        self.masses = np.empty(0)
+        self.radii = np.empty(0)
+        self.lower = np.empty((0, self.dim))
+        self.upper = np.empty((0, self.dim))
+        self.timings = None
 
-cmap = plt.colormaps['jet']
+    def __len__(self):
+        return len(self.masses)
 
-circles = {particle: plt.Circle(tuple(particle.position), particle.radius * 3,
-                                color=cmap(random.random()))
-           for particle in grid.get_particles()}
-for circle in circles.values():
-    ax.add_patch(circle)
+    def kinetic_energy(self):
+        return 0.5 * float(np.sum(self.masses * np.sum(self.velocities ** 2, axis=1)))
+
+    def add_particles(self, positions, velocities, mass=1.0, space=None):
+        positions = np.atleast_2d(np.asarray(positions, dtype=float))
+        velocities = np.atleast_2d(np.asarray(velocities, dtype=float))
+        n = len(positions)
+
+        if positions.shape[1] < self.dim:
+            positions = np.hstack([positions, np.zeros((n, self.dim - positions.shape[1]))])
+            velocities = np.hstack([velocities, np.zeros((n, self.dim - velocities.shape[1]))])
+
+        # Walls outside of the particle's own space are never hit
+        space = self.volume if space is None else space
+        lower = np.full((n, self.dim), -np.inf)
+        upper = np.full((n, self.dim), np.inf)
+        lower[:, :len(space)] = [float(i[0]) for i in space]
+        upper[:, :len(space)] = [float(i[1]) for i in space]
+
+        masses = np.broadcast_to(np.asarray(mass, dtype=float), (n,))
+
+        self.positions = np.vstack([self.positions, positions])
+        self.velocities = np.vstack([self.velocities, velocities])
+        self.previous_velocities = np.vstack([self.previous_velocities, velocities])
+        self.masses = np.concatenate([self.masses, masses])
+        self.radii = np.concatenate([self.radii, radius * masses])
+        self.lower = np.vstack([self.lower, lower])
+        self.upper = np.vstack([self.upper, upper])
+
+    # Same initial distribution as Particle, drawn for n particles at once
+    def add_random(self, n, ini_volume, ini_temp, mass=1.0, space=None):
+        low = np.array([float(i[0] + radius) for i in ini_volume])
+        high = np.array([float(i[1] - radius) for i in ini_volume])
+        positions = np.random.uniform(low, high, (n, len(ini_volume)))
+
+        v = math.sqrt(3 * 8.317162 * ini_temp / mass)
+        velocities = np.random.randint(int(v*0.7), int(v*1.3), (n, len(ini_volume))).astype(float)
+        if len(ini_volume) == 2:
+            theta = np.random.uniform(-np.pi, np.pi, n)
+            cos, sin = np.cos(theta), np.sin(theta)
+            velocities = np.column_stack([cos * velocities[:, 0] - sin * velocities[:, 1],
+                                          sin * velocities[:, 0] + cos * velocities[:, 1]])
+
+        self.add_particles(positions, velocities, mass, ini_volume if space is None else space)
+
+    def add_particle(self, particle):
+        self.add_particles(particle.position, particle.velocity, particle.mass, particle.space)
+
+    def keys(self):
+        return np.floor(self.positions / self.separation).astype(np.int64)
+
+    # Candidate pairs (i < j) of particles in the same or adjacent cells
+    def pairs(self):
+        return cell_pairs(self.keys())
+
+    # Velocities after collision for the candidate pairs that actually overlap and are still
+    # approaching, a pair that already bounced may overlap for another step while it separates
+    def collisions(self, i, j):
+        separation = self.positions[i] - self.positions[j]
+        distance = np.linalg.norm(separation, axis=1)
+        approaching = np.sum((self.previous_velocities[i] - self.previous_velocities[j]) * separation, axis=1) < 0
+        hit = (distance <= self.radii[i] + self.radii[j]) & approaching
+        i, j = i[hit], j[hit]
+
+        m1 = self.masses[i, None]
+        m2 = self.masses[j, None]
+        M = m1 + m2
+        v1 = self.previous_velocities[i]
+        v2 = self.previous_velocities[j]
+
+        return i, j, ((m1 - m2) * v1 + (2 * m2) * v2) / M, ((m2 - m1) * v2 + (2 * m1) * v1) / M
+
+    # Apply the collisions of the candidate pairs
+    def collide(self, i, j):
+        i, j, velocity_i, velocity_j = self.collisions(i, j)
+        self.velocities[i] = velocity_i
+        self.velocities[j] = velocity_j
+
+    def drift(self, dt):
+        self.positions += self.velocities * dt
+
+    # Reflect the particles that reach a wall while moving into it and give back which axes of which
+    # particles hit one. The collisions start from the reflected velocities, or a particle would be
+    # sent into the wall again
+    def walls(self):
+        condition_table = (((self.lower > self.positions - radius) & (self.velocities < 0)) |
+                           ((self.upper < self.positions + radius) & (self.velocities > 0)))
+        self.velocities[condition_table] *= -1
+        self.previous_velocities[:] = self.velocities
+        return condition_table
+
+    def update(self, dt):
+        start = time.perf_counter()
+        i, j = self.pairs()
+        searched = time.perf_counter()
+
+        self.collide(i, j)
+        collided = time.perf_counter()
+
+        self.drift(dt)
+        # Every wall hit gives the wall 2 m |v_n|, the same as the event-driven engine
+        condition_table = self.walls()
+        momentum = float(np.sum(condition_table * 2 * self.masses[:, None] * np.abs(self.velocities)))
+
+        if self.timings is not None:
+            add_timings(self.timings, search=searched - start, collisions=collided - searched,
+                        walls=time.perf_counter() - collided, rebucket=0.0)
+
+        return momentum
+
+
+# Event-driven engine, predicts the time of the next particle or wall collision for every
+# particle, keeps them in a priority queue and jumps straight from one event to the next.
+# Particles are only drifted when they take part in an event, self.times holds the time
+# each particle's position refers to.
+# Particles are kept in the cells of the cell list, at least one interaction diameter wide, so a
+# particle can only hit those in its own and the neighbouring cells. Leaving a cell is an event
+# as well, the particle then looks for collisions with its new neighbours
+class EventDriven:
+    def __init__(self, particles, time=0.0, occupancy=16):
+        self.particles = particles
+        self.time = time
+        self.times = np.full(len(particles), time)
+        self.counts = np.zeros(len(particles), dtype=np.int64)
+        self.queue = []
+        self.sequence = 0
+        self.momentum = 0.0
+        self.events = 0
+        self.crossings = 0
+
+        self.dim = particles.dim
+        # Cells hold occupancy particles on average. A few more candidates cost little next to the
+        # work of an event, so cells larger than the interaction diameter are cheaper as they are crossed less
+        volume = math.prod(i[1] - i[0] for i in particles.volume)
+        self.size = np.maximum((occupancy * volume / max(len(particles), 1)) ** (1 / len(particles.volume)),
+                               2 * particles.radii.max(initial=0))
+        self.size = np.broadcast_to(self.size, (self.dim,)).copy()
+        self.offsets = list(product(range(-1, 2), repeat=self.dim))
+        self.keys = np.floor(particles.positions / self.size).astype(np.int64)
+        self.cells = {}
+        for i, key in enumerate(map(tuple, self.keys)):
+            self.cells.setdefault(key, set()).add(i)
+
+        for i in range(len(particles)):
+            self.predict(i)
+
+    def __len__(self):
+        return len(self.particles)
+
+    def kinetic_energy(self):
+        return self.particles.kinetic_energy()
+
+    def positions_at(self, t):
+        return self.particles.positions + self.particles.velocities * (t - self.times)[:, None]
+
+    def advance_particle(self, i, t):
+        self.particles.positions[i] += self.particles.velocities[i] * (t - self.times[i])
+        self.times[i] = t
+
+    def push(self, t, i, j):
+        heapq.heappush(self.queue, (t, self.sequence, i, j, self.counts[i], self.counts[j] if j >= 0 else 0))
+        self.sequence += 1
+
+    # Every particle in the cell of key and the cells around it
+    def neighbours(self, key):
+        key = tuple(key.tolist())
+        cells = [self.cells.get(tuple(k + o for k, o in zip(key, offset)), _empty_set) for offset in self.offsets]
+        return np.fromiter(chain.from_iterable(cells), dtype=np.int64)
+
+    # Only the earliest event of each particle is queued, walls are stored as j = -1 - axis
+    # and leaving the cell across an axis as j = -1 - dim - axis
+    def predict(self, i):
+        p = self.particles
+        position = p.positions[i] + p.velocities[i] * (self.time - self.times[i])
+        velocity = p.velocities[i]
+
+        # The wall and the edge of the cell ahead on every axis, a wall nearer than the edge is hit first
+        ahead = velocity > 0
+        walls = np.where(ahead, p.upper[i] - radius, p.lower[i] + radius)
+        edges = (self.keys[i] + ahead) * self.size
+        hit_wall = np.where(ahead, walls <= edges, walls >= edges)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            times = np.maximum((np.where(hit_wall, walls, edges) - position) / velocity, 0)
+        times[velocity == 0] = np.inf
+        axis = int(np.argmin(times))
+        t, j = times[axis], -1 - axis if hit_wall[axis] else -1 - self.dim - axis
+
+        others = self.neighbours(self.keys[i])
+        others = others[others != i]
+        if len(others):
+            dr = p.positions[others] + p.velocities[others] * (self.time - self.times[others])[:, None] - position
+            dv = p.velocities[others] - velocity
+            dvdr = np.einsum("ij,ij->i", dv, dr)
+            dvdv = np.einsum("ij,ij->i", dv, dv)
+            sigma = p.radii[others] + p.radii[i]
+            d = dvdr ** 2 - dvdv * (np.einsum("ij,ij->i", dr, dr) - sigma ** 2)
+
+            with np.errstate(divide="ignore", invalid="ignore"):
+                hits = np.where((dvdr < 0) & (d >= 0), -(dvdr + np.sqrt(d)) / dvdv, np.inf)
+            hits[hits < 0] = np.inf
+
+            other = int(np.argmin(hits))
+            if hits[other] < t:
+                t, j = hits[other], int(others[other])
+
+        if np.isfinite(t):
+            self.push(self.time + t, i, j)
+
+    # Move a particle into the next cell along an axis, its path does not change so the
+    # events the others predicted with it stay valid
+    def cross(self, i, axis):
+        key = tuple(self.keys[i])
+        self.cells[key].discard(i)
+        if not self.cells[key]:
+            del self.cells[key]
+        self.keys[i, axis] += 1 if self.particles.velocities[i, axis] > 0 else -1
+        self.cells.setdefault(tuple(self.keys[i]), set()).add(i)
+        self.crossings += 1
+
+    def resolve(self, i, j):
+        p = self.particles
+        dr = p.positions[j] - p.positions[i]
+        dv = p.velocities[j] - p.velocities[i]
+        sigma = p.radii[i] + p.radii[j]
+        impulse = 2 * p.masses[i] * p.masses[j] * np.dot(dv, dr) / (sigma * (p.masses[i] + p.masses[j]))
+        impulse = impulse * dr / sigma
+
+        p.velocities[i] += impulse / p.masses[i]
+        p.velocities[j] -= impulse / p.masses[j]
+
+    # Process every event up to time t_end and return the momentum given to the walls
+    def advance(self, t_end):
+        momentum = 0.0
+        while self.queue and self.queue[0][0] <= t_end:
+            t, _, i, j, count_i, count_j = heapq.heappop(self.queue)
+            if count_i != self.counts[i]:
+                continue
+
+            self.time = t
+            if j >= 0 and count_j != self.counts[j]:
+                self.predict(i)
+                continue
+
+            if j < -self.dim:
+                self.cross(i, -1 - self.dim - j)
+                self.predict(i)
+                continue
+
+            self.advance_particle(i, t)
+            if j >= 0:
+                self.advance_particle(j, t)
+                self.resolve(i, j)
+                self.counts[j] += 1
+            else:
+                axis = -1 - j
+                self.particles.velocities[i, axis] *= -1
+                momentum += 2 * self.particles.masses[i] * abs(self.particles.velocities[i, axis])
+            self.counts[i] += 1
+            self.events += 1
+
+            self.predict(i)
+            if j >= 0:
+                self.predict(j)
+
+        self.time = t_end
+        self.momentum += momentum
+        return momentum
+
+    # Bring every position to the current time, e.g. before drawing
+    def synchronise(self):
+        self.particles.positions[:] = self.positions_at(self.time)
+        self.times[:] = self.time
+
+    def update(self, dt):
+        momentum = self.advance(self.time + dt)
+        self.synchronise()
+        return momentum
+
+
+_shared_fields = ("positions", "velocities", "previous_velocities", "masses", "radii", "lower", "upper")
+
+
+# Advances the particles whose x coordinate lies in the slab [lo, hi). Particles up to one
+# cell outside the slab are read as ghosts, and particles that crossed a slab boundary are
+# handed over simply by their new position on the next step. Only the candidates within a skin
+# of that band are looked at, they are found again from every particle once any slab reports that
+# one of its particles moved further than the skin since then, so a step costs O(N / workers)
+def slab_worker(names, shapes, volume, num, lo, hi, commands, results, barrier, drift_name, index):
+    blocks = [shared_memory.SharedMemory(name=name) for name in names]
+    particles = ParticleArrays(volume, num)
+    for field, block, shape in zip(_shared_fields, blocks, shapes):
+        setattr(particles, field, np.ndarray(shape, dtype=float, buffer=block.buf))
+    drift_block = shared_memory.SharedMemory(name=drift_name)
+    drifts = np.ndarray((barrier.parties,), dtype=float, buffer=drift_block.buf)
+    halo = particles.separation[0]
+    skin = halo
+    candidates = None
+
+    while True:
+        command = commands.get()
+        if command is None:
+            break
+
+        dt, steps = command
+        momentum = 0.0
+        try:
+            for _ in range(steps):
+                if candidates is None:
+                    x = particles.positions[:, 0]
+                    candidates = np.flatnonzero((x >= lo - halo - skin) & (x < hi + halo + skin))
+                    reference = x[candidates].copy()
+
+                x = particles.positions[candidates, 0]
+                owned = (x >= lo) & (x < hi)
+                local = candidates[(x >= lo - halo) & (x < hi + halo)]
+
+                # Collisions only read positions and previous velocities, so every slab
+                # can write the new velocities of its own particles at the same time
+                first, second = cell_pairs(np.floor(particles.positions[local] / particles.separation))
+                i, j, velocity_i, velocity_j = particles.collisions(local[first], local[second])
+                i_owned = (particles.positions[i, 0] >= lo) & (particles.positions[i, 0] < hi)
+                j_owned = (particles.positions[j, 0] >= lo) & (particles.positions[j, 0] < hi)
+                particles.velocities[i[i_owned]] = velocity_i[i_owned]
+                particles.velocities[j[j_owned]] = velocity_j[j_owned]
+                barrier.wait()
+
+                own = candidates[owned]
+                particles.positions[own] += particles.velocities[own] * dt
+
+                position = particles.positions[own]
+                velocity = particles.velocities[own]
+                condition_table = (((particles.lower[own] > position - radius) & (velocity < 0)) |
+                                   ((particles.upper[own] < position + radius) & (velocity > 0)))
+                velocity = np.where(condition_table, -velocity, velocity)
+                particles.velocities[own] = velocity
+                particles.previous_velocities[own] = velocity
+                momentum += float(np.sum(condition_table * 2 * particles.masses[own, None] * np.abs(velocity)))
+
+                # How far the particles of this slab moved along x since the candidates were found
+                drifts[index] = float(np.max(np.abs(particles.positions[own, 0] - reference[owned]), initial=0))
+                barrier.wait()
+
+                # Every slab sees the same drifts here, so they all look for candidates again together
+                if drifts.max() > skin:
+                    candidates = None
+        except Exception as error:
+            # Let the other slabs out of the barrier instead of leaving them waiting forever
+            barrier.abort()
+            results.put(RuntimeError(f"slab [{lo}, {hi}): {error!r}"))
+            break
+
+        results.put(momentum)
+
+    for field in _shared_fields:
+        setattr(particles, field, None)
+    drifts = None
+    for block in blocks + [drift_block]:
+        block.close()
+
+
+# Splits the volume into slabs along the first axis with one worker process per slab,
+# the particle state of a ParticleArrays population is moved into shared memory.
+# A slab that fails or stops answering for timeout seconds stops the whole step with an error
+class SlabGrid:
+    def __init__(self, particles, workers=None, timeout=60.0):
+        self.particles = particles
+        volume = particles.volume
+        width = volume[0][1] - volume[0][0]
+
+        # Every slab must be at least one cell wide for the halo to hold all neighbours
+        workers = workers or os.cpu_count() or 1
+        workers = max(1, min(workers, int(width // particles.separation[0])))
+        self.edges = np.linspace(volume[0][0], volume[0][1], workers + 1)
+        self.edges[0], self.edges[-1] = -np.inf, np.inf
+
+        self.blocks = []
+        for field in _shared_fields:
+            array = getattr(particles, field)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            shared = np.ndarray(array.shape, dtype=float, buffer=block.buf)
+            shared[:] = array
+            setattr(particles, field, shared)
+            self.blocks.append(block)
+        self.drift_block = shared_memory.SharedMemory(create=True, size=8 * workers)
+
+        names = [block.name for block in self.blocks]
+        shapes = [getattr(particles, field).shape for field in _shared_fields]
+        self.timeout = timeout
+        self.barrier = multiprocessing.Barrier(workers, timeout=timeout)
+        self.results = multiprocessing.Queue()
+        self.commands = [multiprocessing.Queue() for _ in range(workers)]
+        self.processes = [multiprocessing.Process(target=slab_worker, daemon=True,
+                                                  args=(names, shapes, volume, particles.num, lo, hi, commands,
+                                                        self.results, self.barrier, self.drift_block.name, index))
+                          for index, (lo, hi, commands) in enumerate(zip(self.edges[:-1], self.edges[1:],
+                                                                         self.commands))]
+        for process in self.processes:
+            process.start()
+
+    def __len__(self):
+        return len(self.particles)
+
+    def kinetic_energy(self):
+        return self.particles.kinetic_energy()
+
+    # Runs a number of steps in every slab and sums the wall momentum of all slabs. While waiting
+    # the workers are checked, a dead one would otherwise leave the others in the barrier
+    def update(self, dt, steps=1):
+        for commands in self.commands:
+            commands.put((dt, steps))
+
+        results = []
+        while len(results) < len(self.processes):
+            try:
+                results.append(self.results.get(timeout=0.5))
+            except queue.Empty:
+                if not all(process.is_alive() for process in self.processes):
+                    self.barrier.abort()
+                    raise RuntimeError("A slab worker stopped during the step")
+
+        # The slab that failed first is the cause, the others only saw the barrier break
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            raise next((error for error in errors if "BrokenBarrierError" not in str(error)), errors[0])
+        return sum(results)
+
+    # Stops the workers and gives the particles their own copy of the state back
+    def close(self):
+        for commands in self.commands:
+            commands.put(None)
+        for process in self.processes:
+            process.join()
+
+        for field in _shared_fields:
+            setattr(self.particles, field, getattr(self.particles, field).copy())
+        for block in self.blocks + [self.drift_block]:
+            block.close()
+            block.unlink()
+        self.blocks = []
+        self.drift_block = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Append-only columnar output, every column is its own raw float64 file in the directory
+# so runs can be extended and single observables read back without parsing the rest.
+# A new run removes the columns already in the directory, only a restart appends to them
+class ObservableWriter:
+    def __init__(self, directory, columns, chunk=1000, append=False):
+        os.makedirs(directory, exist_ok=True)
+        if not append:
+            for name in os.listdir(directory):
+                if name.endswith(".f8"):
+                    os.remove(os.path.join(directory, name))
+        self.directory = directory
+        self.columns = columns
+        self.chunk = chunk
+        self.rows = []
+
+    def append(self, *row):
+        self.rows.append(row)
+        if len(self.rows) >= self.chunk:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        data = np.array(self.rows, dtype=np.float64)
+        for i, column in enumerate(self.columns):
+            with open(os.path.join(self.directory, column + ".f8"), "ab") as file:
+                file.write(data[:, i].tobytes())
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+
+def read_observables(directory):
+    return {name[:-3]: np.fromfile(os.path.join(directory, name), dtype=np.float64)
+            for name in sorted(os.listdir(directory)) if name.endswith(".f8")}
+
+
+# The measure of the walls of the box, the perimeter in 2D
+def wall_area(volume):
+    sides = [i[1] - i[0] for i in volume]
+    return sum(2 * math.prod(sides[:i] + sides[i + 1:]) for i in range(len(sides)))
+
+
+# The heavy gas filling the box plus the hot, light cloud in the middle
+def build_grid(volume, temp, heavy=100, light=500, num=None):
+    grid = Grid(volume, num)
+
+    for i in range(heavy):
+        particle = Particle(volume, temp, 1)
+        grid.add_particle(particle)
+
+    for i in range(light):
+        particle = Particle([(-1, 1), (-1, 1)], temp * 3, 0.4)
+        particle.space = volume
+        grid.add_particle(particle)
+
+    return grid
+
+
+def build_arrays(volume, temp, heavy=100, light=500, num=10 / 0.1):
+    particles = ParticleArrays(volume, num)
+    particles.add_random(heavy, volume, temp, 1)
+    particles.add_random(light, [(-1, 1), (-1, 1)], temp * 3, 0.4, volume)
+    return particles
 
-dt = 0.001
-total = 0
-totals = []
 
-def animate(frame):
-    global total, totals
+# Advance any engine for a number of steps or a simulated time without plotting,
+# streaming the observables of every step to the output directory
+def headless(engine, volume, dt, steps=None, duration=None, output="collisions_run", chunk=1000,
+             start=0, checkpoint=None, checkpoint_every=None):
+    if steps is None:
+        steps = int(math.ceil(duration / dt))
+    area = wall_area(volume)
 
-    if frame == 9:
-        totals.append(total)
-        totals = totals[-10:]
-        total = 0
+    with ObservableWriter(output, ("step", "time", "momentum", "pressure", "kinetic_energy", "particles"),
+                          chunk, append=start > 0) as writer:
+        for step in range(start, start + steps):
+            momentum = engine.update(dt)
+            writer.append(step, (step + 1) * dt, momentum, momentum / (area * dt),
+                          engine.kinetic_energy(), len(engine))
 
-    total += grid.update(dt)
+            if checkpoint is not None and checkpoint_every and (step + 1) % checkpoint_every == 0:
+                writer.flush()
+                save_snapshot(checkpoint, engine, step + 1, dt, output)
 
-    for particle in grid.get_particles():
-        circles[particle].set_center(tuple(particle.position))
+    return read_observables(output)
 
-    if len(totals) > 0:
-        text.txt.set_text(f"{np.mean(totals) /(40.0 * dt)}")
 
-    return circles, text
+_snapshot_fields = ("positions", "velocities", "previous_velocities", "lower", "upper", "masses", "radii")
 
 
-ani = animation.FuncAnimation(fig, animate, 10, interval=0)
-plt.grid("minor")
-plt.show()
\ No newline at end of file
+# Saves an array engine, the random number generator states and the step counter. The particle
+# state is one (N, fields) float64 .npy written through a memory map, next to a small json file.
+# The snapshot is written beside the old one, the old one is moved aside and only removed once the
+# new one is in place, so a crash never leaves it half written or without a good snapshot
+def save_snapshot(path, engine, step, dt, output=None):
+    if isinstance(engine, Grid):
+        raise TypeError("Snapshots need the arrays or events engine")
+
+    kind = "events" if isinstance(engine, EventDriven) else "arrays"
+    if kind == "events":
+        engine.synchronise()
+    particles = getattr(engine, "particles", engine)
+
+    columns = [np.atleast_2d(getattr(particles, field).T).T for field in _snapshot_fields]
+    temporary = path + ".tmp"
+    os.makedirs(temporary, exist_ok=True)
+    state = np.lib.format.open_memmap(os.path.join(temporary, "state.npy"), mode="w+", dtype=np.float64,
+                                      shape=(len(particles), sum(column.shape[1] for column in columns)))
+    state[:] = np.hstack(columns)
+    state.flush()
+    del state
+
+    numpy_state = np.random.get_state()
+    python_state = random.getstate()
+    meta = {
+        "kind": kind,
+        "step": step,
+        "time": engine.time if kind == "events" else step * dt,
+        "dt": dt,
+        "volume": [list(i) for i in particles.volume],
+        "num": particles.num,
+        "dim": particles.dim,
+        "numpy_random": [numpy_state[0], numpy_state[1].tolist(), *numpy_state[2:]],
+        "python_random": [python_state[0], list(python_state[1]), python_state[2]],
+        "rows": None,
+        "output": None,
+    }
+    # The row count comes from the size of one column, so it does not grow with the run
+    if output is not None:
+        meta["output"] = os.path.abspath(output)
+        step_file = os.path.join(output, "step.f8")
+        meta["rows"] = os.path.getsize(step_file) // 8 if os.path.exists(step_file) else 0
+    with open(os.path.join(temporary, "meta.json"), "w") as file:
+        json.dump(meta, file)
+
+    previous = path + ".old"
+    if os.path.isdir(previous):
+        shutil.rmtree(previous)
+    if os.path.isdir(path):
+        os.replace(path, previous)
+    os.replace(temporary, path)
+    if os.path.isdir(previous):
+        shutil.rmtree(previous)
+
+
+# Restores an engine from a snapshot, the cost only depends on the number of particles.
+# Restarting into the output of the saved run cuts off the observables written after the
+# snapshot so the restarted run appends cleanly. Any other output is created if it is missing
+# and must not hold the observables of another run
+def load_snapshot(path, output=None):
+    # A crash between moving the old snapshot aside and moving the new one in leaves only the old one
+    if not os.path.isdir(path) and os.path.isdir(path + ".old"):
+        path = path + ".old"
+
+    with open(os.path.join(path, "meta.json")) as file:
+        meta = json.load(file)
+
+    state = np.load(os.path.join(path, "state.npy"), mmap_mode="r")
+    particles = ParticleArrays([tuple(i) for i in meta["volume"]], meta["num"])
+    widths = [particles.dim] * 5 + [1, 1]
+    bounds = np.cumsum([0] + widths)
+    for field, lo, hi in zip(_snapshot_fields, bounds[:-1], bounds[1:]):
+        column = np.array(state[:, lo:hi])
+        setattr(particles, field, column[:, 0] if field in ("masses", "radii") else column)
+    del state
+
+    numpy_state = meta["numpy_random"]
+    np.random.set_state((numpy_state[0], np.array(numpy_state[1], dtype=np.uint32), *numpy_state[2:]))
+    python_state = meta["python_random"]
+    random.setstate((python_state[0], tuple(python_state[1]), python_state[2]))
+
+    if output is not None:
+        os.makedirs(output, exist_ok=True)
+        columns = [name for name in os.listdir(output) if name.endswith(".f8")]
+        if os.path.abspath(output) == meta.get("output") and meta["rows"] is not None:
+            for name in columns:
+                os.truncate(os.path.join(output, name), meta["rows"] * 8)
+        elif columns:
+            raise ValueError(f"{output} holds the observables of another run, restart into an empty directory")
+
+    if meta["kind"] == "events":
+        engine = EventDriven(particles, meta["time"])
+    else:
+        engine = particles
+
+    return engine, meta["step"]
+
+
+def animated(grid, volume, dt):
+    fig, ax = plt.subplots()
+    ax.set(xlim=[volume[0][0], volume[0][1]], ylim=[-10, 10])
+
+    text = offsetbox.AnchoredText("0", loc=1)
+    ax.add_artist(text)
+
+    cmap = plt.colormaps['jet']
+
+    circles = {particle: plt.Circle(tuple(particle.position), particle.radius * 3,
+                                    color=cmap(random.random()))
+               for particle in grid.get_particles()}
+    for circle in circles.values():
+        ax.add_patch(circle)
+
+    # Every total is the wall momentum of the 10 steps of one loop of the frames
+    area = wall_area(volume)
+    total = 0
+    totals = []
+
+    def animate(frame):
+        nonlocal total, totals
+
+        if frame == 9:
+            totals.append(total)
+            totals = totals[-10:]
+            total = 0
+
+        total += grid.update(dt)
+
+        for particle in grid.get_particles():
+            circles[particle].set_center(tuple(particle.position))
+
+        if len(totals) > 0:
+            text.txt.set_text(f"{np.mean(totals) / (area * dt * 10)}")
+
+        return circles, text
+
+    ani = animation.FuncAnimation(fig, animate, 10, interval=0)
+    plt.grid("minor")
+    plt.show()
+
+
+# Positions and radii as (N, dim) and (N,) arrays whatever the engine
+def engine_state(engine):
+    if isinstance(engine, Grid):
+        particles = list(engine.get_particles())
+        return np.array([particle.position for particle in particles]), np.array([particle.radius for particle in particles])
+    particles = getattr(engine, "particles", engine)
+    return particles.positions, particles.radii
+
+
+# Draws every particle as one EllipseCollection whose offsets are set from the position
+# array, blitting only redraws the collection and the pressure text. The engine is
+# advanced `every` steps per drawn frame
+def animated_collection(engine, volume, dt, every=1):
+    fig, ax = plt.subplots()
+    ax.set(xlim=[volume[0][0], volume[0][1]], ylim=[volume[1][0], volume[1][1]])
+
+    text = offsetbox.AnchoredText("0", loc=1)
+    ax.add_artist(text)
+
+    positions, radii = engine_state(engine)
+    cmap = plt.colormaps['jet']
+    collection = EllipseCollection(radii * 6, radii * 6, np.zeros(len(radii)), units="xy",
+                                   offsets=positions[:, :2], offset_transform=ax.transData,
+                                   facecolors=cmap(np.random.random(len(radii))))
+    ax.add_collection(collection)
+
+    area = wall_area(volume)
+    totals = []
+
+    def animate(frame):
+        nonlocal totals
+
+        total = sum(engine.update(dt) for _ in range(every))
+        totals = (totals + [total])[-10:]
+
+        collection.set_offsets(engine_state(engine)[0][:, :2])
+        text.txt.set_text(f"{np.mean(totals) / (area * dt * every)}")
+
+        return collection, text
+
+    ani = animation.FuncAnimation(fig, animate, interval=0, blit=True, cache_frame_data=False)
+    plt.grid("minor")
+    plt.show()
+
+
+temp = 200
+volume = [(-10.0, 10.0), (-10.0, 10.0)]
+dt = 0.001
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hard sphere gas in a box")
+    parser.add_argument("--headless", action="store_true", help="run without plotting")
+    parser.add_argument("--engine", choices=["grid", "arrays", "events", "slabs"], default="grid")
+    parser.add_argument("--workers", type=int, default=None, help="slab worker processes, every core by default")
+    parser.add_argument("--steps", type=int, default=None)
+    parser.add_argument("--time", type=float, default=None, help="simulated time to run for")
+    parser.add_argument("--dt", type=float, default=dt)
+    parser.add_argument("--temp", type=float, default=temp)
+    parser.add_argument("--size", type=float, default=10.0, help="half width of the box")
+    parser.add_argument("--heavy", type=int, default=100)
+    parser.add_argument("--light", type=int, default=500)
+    parser.add_argument("--output", default="collisions_run")
+    parser.add_argument("--checkpoint", default=None, help="snapshot directory for the arrays and events engines")
+    parser.add_argument("--checkpoint-every", type=int, default=None, help="steps between snapshots")
+    parser.add_argument("--restart", default=None, help="snapshot directory to continue from")
+    parser.add_argument("--every", type=int, default=1, help="simulation steps per drawn frame")
+    parser.add_argument("--patches", action="store_true", help="draw one Circle patch per particle")
+    args = parser.parse_args()
+
+    if args.checkpoint and args.engine == "grid" and not args.restart:
+        parser.error("--checkpoint needs --engine arrays or events, the grid engine cannot be saved")
+    if bool(args.checkpoint) != bool(args.checkpoint_every):
+        parser.error("--checkpoint and --checkpoint-every have to be given together")
+
+    volume = [(-args.size, args.size), (-args.size, args.size)]
+
+    if args.patches:
+        args.engine = "grid"
+
+    start = 0
+    if args.restart:
+        try:
+            engine, start = load_snapshot(args.restart, args.output)
+        except ValueError as error:
+            parser.error(str(error))
+        volume = getattr(engine, "particles", engine).volume
+    elif args.engine == "grid":
+        engine = build_grid(volume, args.temp, args.heavy, args.light)
+    elif args.engine == "arrays":
+        engine = build_arrays(volume, args.temp, args.heavy, args.light)
+    elif args.engine == "slabs":
+        engine = SlabGrid(build_arrays(volume, args.temp, args.heavy, args.light), args.workers)
+    else:
+        engine = EventDriven(build_arrays(volume, args.temp, args.heavy, args.light))
+
+    try:
+        if args.headless:
+            steps = args.steps if args.steps is not None or args.time is not None else 1000
+            observables = headless(engine, volume, args.dt, steps, args.time, args.output,
+                                   start=start, checkpoint=args.checkpoint, checkpoint_every=args.checkpoint_every)
+            print(f"{len(observables['step'])} steps written to {args.output}, "
+                  f"mean pressure {np.mean(observables['pressure'])}")
+        elif args.patches:
+            animated(engine, volume, args.dt)
+        else:
+            animated_collection(engine, volume, args.dt, args.every)
+    finally:
+        # The slab workers and their shared memory have to be released
+        if isinstance(engine, SlabGrid):
+            engine.close()
\ No newline at end of file
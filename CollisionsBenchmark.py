@@ -0,0 +1,109 @@
+import argparse
+import json
+import time
+import tracemalloc
+from itertools import product
+
+from Collisions import Grid, Particle, ParticleArrays, EventDriven, SlabGrid, radius
+
+
+# A box of the given size and dimension filled with particles of unit mass
+def build(engine, particles, size, num, dim, temp=200, workers=None):
+    volume = [(-size, size)] * dim
+
+    if engine in ("arrays", "events", "slabs"):
+        population = ParticleArrays(volume, num if num is not None else size / radius)
+        population.add_random(particles, volume, temp, 1)
+        if engine == "events":
+            return EventDriven(population)
+        if engine == "slabs":
+            return SlabGrid(population, workers)
+        return population
+
+    grid = Grid(volume, num, search=engine)
+    for i in range(particles):
+        grid.add_particle(Particle(volume, temp, 1))
+    return grid
+
+
+# Slab workers release their processes and shared memory when closed
+def close(simulation):
+    if isinstance(simulation, SlabGrid):
+        simulation.close()
+
+
+# Only the memory of this process is traced, not the one of the slab workers
+def peak_memory(engine, particles, size, num, dim, dt, steps, workers=None):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    simulation = build(engine, particles, size, num, dim, workers=workers)
+    for i in range(steps):
+        simulation.update(dt)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    close(simulation)
+    return peak
+
+
+# Runs one configuration headless and reports its throughput, memory and time split
+def run_case(engine, particles, size, num, dim, dt, steps, memory_steps, workers=None):
+    simulation = build(engine, particles, size, num, dim, workers=workers)
+    timings = {}
+    population = getattr(simulation, "particles", simulation)
+    if hasattr(population, "timings"):
+        population.timings = timings
+
+    start = time.perf_counter()
+    for i in range(steps):
+        simulation.update(dt)
+    elapsed = time.perf_counter() - start
+    close(simulation)
+
+    return {
+        "engine": engine,
+        "particles": particles,
+        "size": size,
+        "num": num,
+        "dim": dim,
+        "workers": len(simulation.processes) if isinstance(simulation, SlabGrid) else 1,
+        "density": particles / (2 * size) ** dim,
+        "cell_size": float(min(population.separation)),
+        "interaction_diameter": 2 * radius,
+        "steps": steps,
+        "dt": dt,
+        "seconds": elapsed,
+        "steps_per_second": steps / elapsed,
+        "particle_updates_per_second": steps * particles / elapsed,
+        "peak_memory_bytes": peak_memory(engine, particles, size, num, dim, dt, memory_steps, workers),
+        "timings": {phase: value / steps for phase, value in timings.items()},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the Collisions engines over a parameter matrix")
+    parser.add_argument("--engine", nargs="+", default=["dense", "sorted", "arrays"],
+                        choices=["dense", "sorted", "arrays", "events", "slabs"])
+    parser.add_argument("--particles", nargs="+", type=int, default=[100, 1000])
+    parser.add_argument("--size", nargs="+", type=float, default=[10.0], help="half width of the box")
+    parser.add_argument("--num", nargs="+", type=lambda value: None if value == "auto" else float(value),
+                        default=[100.0], help="cells along each axis, or auto")
+    parser.add_argument("--dim", nargs="+", type=int, default=[2])
+    parser.add_argument("--workers", type=int, default=None, help="slab worker processes, every core by default")
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--memory-steps", type=int, default=2)
+    parser.add_argument("--dt", type=float, default=0.001)
+    parser.add_argument("--output", default="collisions_benchmark.jsonl")
+    args = parser.parse_args()
+
+    with open(args.output, "a") as file:
+        for engine, particles, size, num, dim in product(args.engine, args.particles, args.size, args.num, args.dim):
+            result = run_case(engine, particles, size, num, dim, args.dt, args.steps, args.memory_steps, args.workers)
+            file.write(json.dumps(result) + "\n")
+            file.flush()
+
+            split = ", ".join(f"{phase} {value * 1000:.3f}ms" for phase, value in result["timings"].items())
+            print(f"{engine:>6} N={particles} size={size} num={num} dim={dim}: "
+                  f"{result['steps_per_second']:.1f} steps/s, "
+                  f"{result['particle_updates_per_second']:.0f} updates/s, "
+                  f"peak {result['peak_memory_bytes'] / 2 ** 20:.1f}MiB"
+                  + (f" ({split})" if split else ""))
\ No newline at end of file
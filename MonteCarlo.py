@@ -1,12 +1,16 @@
 # Import the needed packages
 import math  # To do the mathematical operations
-import random  # To generate the pseudo-random numbers needed for Monte Carlo Simulations
+import multiprocessing  # To run the sampling on every core
+import time  # To time the integrations
+from statistics import NormalDist  # To turn a confidence level into a number of standard errors
+import numpy as np  # To generate the pseudo-random numbers needed for Monte Carlo Simulations in large chunks
 import matplotlib.pyplot as plt  # To visualise the results
 
 
 # Function to Create the figure, given points inside function,
-# Outside of it, the results and the value that is being plotted
-def create_fig(xi, xo, yi, yo, results, value, name):
+# Outside of it, the results and the value that is being plotted.
+# The iterations the results were taken at can be given when they are not every point
+def create_fig(xi, xo, yi, yo, results, value, name, iterations=None):
     # The figures are saved as variables
     fig1 = plt.figure(1)
     fig2 = plt.figure(2)
@@ -33,8 +37,12 @@ def create_fig(xi, xo, yi, yo, results, value, name):
     # The accuracy graph is designed by plotting how the approximation given the
     # Number of points and comparing it to a fixed value which is the number we are
     # looking for
-    ax2.plot(results, "k-", label=" numerical " + name)
-    ax2.axhline(value, 0, len(results), color="r", linestyle="-", label=name)
+    if iterations is None:
+        ax2.plot(results, "k-", label=" numerical " + name)
+    else:
+        ax2.plot(iterations, results, "k-", label=" numerical " + name)
+        ax2.set_xscale("log")
+    ax2.axhline(value, color="r", linestyle="-", label=name)
 
     # For this graph, we want a grid, legend and axis titles to understand what is being drawn
     plt.grid(True)
@@ -47,72 +55,620 @@ def create_fig(xi, xo, yi, yo, results, value, name):
     plt.pause(1)
 
 
-# Monte Carlo simulation method
-def monte_carlo_sim(N, region, cond_func, scaling_func, target, target_name):
-    # Arrays for the location of points, separated by inside function
-    # Or outside it
-    xi = []
-    yi = []
-    xo = []
-    yo = []
+# Hit and miss counts of the points on a grid of bins over the region, so that drawing them
+# costs the same however many points there are
+class DensityMap:
+    def __init__(self, region, bins=256):
+        self.region = region
+        self.bins = bins
+        self.counts = np.zeros((2, bins, bins), dtype=np.int64)
+
+    def add(self, x, y, inside):
+        cells = []
+        for values, (low, high) in zip((x, y), self.region):
+            cells.append(np.clip(((values - low) / (high - low) * self.bins).astype(np.int64), 0, self.bins - 1))
+        keys = (inside.astype(np.int64) * self.bins + cells[1]) * self.bins + cells[0]
+        self.counts += np.bincount(keys, minlength=2 * self.bins ** 2).reshape(self.counts.shape)
+
+    def merge(self, other):
+        self.counts += other.counts
+
+    # The points inside in red and the ones outside in blue, on a log scale so sparse bins still show
+    def image(self):
+        image = np.zeros((self.bins, self.bins, 3))
+        for channel, counts in ((2, self.counts[0]), (0, self.counts[1])):
+            image[:, :, channel] = np.log1p(counts) / max(np.log1p(counts.max()), 1)
+        return image
+
+
+# Figures that are set up once and then updated in place with the density map and the trace,
+# without pausing, so drawing does not hold up the sampling or grow with the number of points
+class DensityFigure:
+    def __init__(self, region, value, name, points=2000):
+        self.points = points
+
+        # The figures are saved as variables and cleared once
+        self.figures = (plt.figure(1), plt.figure(2))
+        for fig in self.figures:
+            fig.clf()
+        ax = self.figures[0].add_subplot(1, 1, 1)
+        self.axis = self.figures[1].add_subplot(1, 1, 1)
+
+        # Image
+        self.image = ax.imshow(np.zeros((1, 1, 3)), origin="lower", aspect="auto",
+                               extent=(region[0][0], region[0][1], region[1][0], region[1][1]))
+
+        # Accuracy graph, on a log scale as the trace is taken at log-spaced iterations
+        self.line, = self.axis.plot([], [], "k-", label=" numerical " + name)
+        self.axis.axhline(value, color="r", linestyle="-", label=name)
+        self.axis.set_xscale("log")
+        self.axis.grid(True)
+        self.figures[1].legend()
+        self.axis.set_ylabel(" Result [ -] ")
+        self.axis.set_xlabel(" Iteration [ -] ")
+
+        for fig in self.figures:
+            fig.show()
+
+    def update(self, density, results, iterations):
+        # Only a fixed number of the results are drawn
+        if len(results) > self.points:
+            keep = np.linspace(0, len(results) - 1, self.points).astype(np.int64)
+            results, iterations = np.asarray(results)[keep], np.asarray(iterations)[keep]
+
+        self.image.set_data(density.image())
+        self.line.set_data(iterations, results)
+        self.axis.relim()
+        self.axis.autoscale_view()
+
+        # Ask for a redraw and let the gui handle it without waiting
+        for fig in self.figures:
+            fig.canvas.draw_idle()
+            fig.canvas.flush_events()
+
+
+# Sampling engine, draws the N points uniformly in a box of any dimension in chunks from a numpy
+# generator, every chunk is an array of shape (size, dimensions)
+def sample_box(N, box, chunk=2 ** 20, rng=None):
+    rng = np.random.default_rng() if rng is None else rng
+
+    for start in range(0, N, chunk):
+        size = min(chunk, N - start)
+
+        # Every coordinate is drawn as a whole, so that each of them is contiguous
+        points = np.empty((len(box), size))
+        for i, (low, high) in enumerate(box):
+            points[i] = rng.uniform(low, high, size)
+        yield start, points.T
+
+
+# The points of the engine in the 2D region, with the condition checked on a whole chunk at once,
+# cond_func has to work on arrays of points
+def sample_chunks(N, region, cond_func, chunk=2 ** 20, rng=None):
+    for start, points in sample_box(N, region, chunk, rng):
+        x, y = points[:, 0], points[:, 1]
+
+        # Check which points are under the curve
+        yield start, x, y, cond_func(x, y) <= 1
+
+
+# Samplers, each gives a batch of points in the unit square whose mean is an unbiased estimate of
+# the fraction under the curve. They may give slightly fewer points than asked for
+
+# Independent uniform points
+def uniform_points(size, rng):
+    return rng.random(size), rng.random(size)
+
+
+# Antithetic pairs, every point comes with its reflection through the centre of the square, which
+# for a curve that only goes down is less likely to land on the same side of it. An odd size
+# leaves out the reflection of the last point
+def antithetic_points(size, rng):
+    pairs = -(-size // 2)
+    x, y = rng.random(pairs), rng.random(pairs)
+    return np.concatenate([x, 1 - x])[:size], np.concatenate([y, 1 - y])[:size]
+
+
+# Stratified (jittered) points, the square is split into a grid of equal cells with one point in each
+def stratified_points(size, rng):
+    k = max(math.isqrt(size), 1)
+    cells = np.arange(k * k)
+    return (cells // k + rng.random(k * k)) / k, (cells % k + rng.random(k * k)) / k
+
+
+# Radical inverse of integers in a base, the digits mirrored around the decimal point
+def radical_inverse(n, base):
+    n = n.copy()
+    result = np.zeros(len(n))
+    scale = 1 / base
+    while np.any(n):
+        result += n % base * scale
+        n //= base
+        scale /= base
+    return result
+
+
+# Halton points in bases 2 and 3 with a random shift, so that every batch is an independent estimate
+def halton_points(size, rng):
+    n = np.arange(1, size + 1)
+    return (radical_inverse(n, 2) + rng.random()) % 1, (radical_inverse(n, 3) + rng.random()) % 1
+
+
+# The first two dimensions of the Sobol sequence with a random shift. The direction numbers of the
+# first are the powers of a half, those of the second come from the polynomial x + 1
+def sobol_points(size, rng):
+    n = np.arange(size, dtype=np.uint64)
+    x = np.zeros(size, dtype=np.uint64)
+    y = np.zeros(size, dtype=np.uint64)
+    m = 1
+    for bit in range(32):
+        set_bits = (n >> np.uint64(bit)) & np.uint64(1) == 1
+        x[set_bits] ^= np.uint64(1 << (31 - bit))
+        y[set_bits] ^= np.uint64(m << (31 - bit))
+        m = (m << 1) ^ m
+    return (x / 2 ** 32 + rng.random()) % 1, (y / 2 ** 32 + rng.random()) % 1
+
+
+# Registry of the sampling methods, importance sampling uses uniform points moved by a density
+SAMPLERS = {
+    "uniform": uniform_points,
+    "antithetic": antithetic_points,
+    "stratified": stratified_points,
+    "halton": halton_points,
+    "sobol": sobol_points,
+    "importance": uniform_points,
+}
+
+
+# Move uniform points in [0, 1] to a linear density going from w0 to w1 by inverting its cumulative
+# distribution, and give the weight (uniform density over this density) of every point
+def linear_density(u, w0, w1):
+    mean = (w0 + w1) / 2
+    if w0 == w1:
+        return u, np.ones(len(u))
+    x = (np.sqrt(w0 ** 2 + 2 * (w1 - w0) * mean * u) - w0) / (w1 - w0)
+    return x, mean / (w0 + (w1 - w0) * x)
+
+
+# Convergence trace that only keeps the results at a fixed number of log-spaced iterations,
+# so that the start of the run, where the result changes the most, is still well resolved
+class ConvergenceTrace:
+    def __init__(self, N, points=1000):
+        self.checkpoints = np.unique(np.geomspace(1, max(N, 1), points).astype(np.int64))
+        self.iterations = []
+        self.results = []
+
+    # The checkpoints within the points start + 1 to start + size
+    def within(self, start, size):
+        first, last = np.searchsorted(self.checkpoints, [start + 1, start + size + 1])
+        return self.checkpoints[first:last]
+
+    # Take the results at the checkpoints within a chunk from its cumulative hit counts
+    def record(self, start, counts, scaling_func):
+        iterations = self.within(start, len(counts))
+        self.add(iterations, counts[iterations - start - 1], scaling_func)
+
+    # Add the hit counts at some checkpoints
+    def add(self, iterations, counts, scaling_func):
+        self.iterations.extend(iterations.tolist())
+        self.results.extend(np.atleast_1d(scaling_func(counts / iterations)).tolist())
+
+
+# Fixed size uniform sample of every point seen so far (reservoir sampling), the k-th point
+# replaces a random slot with probability size / k, done for a whole chunk at once
+class Reservoir:
+    def __init__(self, size, rng):
+        self.size = size
+        self.rng = rng
+        self.seen = 0
+        self.x = np.zeros(size)
+        self.y = np.zeros(size)
+        self.inside = np.zeros(size, dtype=bool)
+
+    def add(self, x, y, inside):
+        # The first points fill the reservoir
+        fill = max(0, min(self.size - self.seen, len(x)))
+        self.x[self.seen:self.seen + fill] = x[:fill]
+        self.y[self.seen:self.seen + fill] = y[:fill]
+        self.inside[self.seen:self.seen + fill] = inside[:fill]
+
+        # Later points draw a slot and replace it when the slot is in the reservoir,
+        # later points of the chunk win like they would if added one by one
+        slots = self.rng.integers(0, np.arange(self.seen + fill, self.seen + len(x)) + 1)
+        chosen = np.flatnonzero(slots < self.size) + fill
+        self.x[slots[chosen - fill]] = x[chosen]
+        self.y[slots[chosen - fill]] = y[chosen]
+        self.inside[slots[chosen - fill]] = inside[chosen]
+        self.seen += len(x)
+
+    # The points kept so far, split into the ones inside and outside the function
+    def split(self):
+        n = min(self.seen, self.size)
+        x, y, inside = self.x[:n], self.y[:n], self.inside[:n]
+        return x[inside], x[~inside], y[inside], y[~inside]
+
+
+# Sample one block of points from its own stream, and give back its hit count, the cumulative
+# hit counts at the checkpoints (counted from the start of the block) and its first points,
+# or its density map when there are bins
+def sample_block(task):
+    seed, size, region, cond_func, checkpoints, keep, chunk, bins = task
+    hits = 0
+    at_checkpoints = []
+    kept = None
+    density = DensityMap(region, bins) if bins else None
+
+    for start, x, y, inside in sample_chunks(size, region, cond_func, chunk, np.random.default_rng(seed)):
+        counts = hits + np.cumsum(inside)
+        hits = int(counts[-1])
+
+        within = checkpoints[(checkpoints > start) & (checkpoints <= start + len(x))]
+        at_checkpoints.append(counts[within - start - 1])
+
+        # The points are independent, so the first ones of a block are a uniform sample of it
+        if density is not None:
+            density.add(x, y, inside)
+        elif kept is None:
+            kept = (x[:keep], y[:keep], inside[:keep])
+
+    return hits, np.concatenate(at_checkpoints), kept if density is None else density
+
+
+# Parallel Monte Carlo simulation. The N points are split into blocks of a fixed size, and block k
+# always draws from the k-th stream spawned from the seed, whichever worker it runs on. The
+# estimate is therefore the same for any number of workers. Memory does not depend on N
+def monte_carlo_parallel(N, region, cond_func, scaling_func, target, target_name, workers=None, seed=None,
+                         block=2 ** 22, chunk=2 ** 20, plot=True, reservoir=10000, checkpoints=1000, render="scatter",
+                         bins=256):
+    starts = range(0, N, block)
+    streams = np.random.SeedSequence(seed).spawn(len(starts))
+    trace = ConvergenceTrace(N, checkpoints)
+    keep = -(-reservoir // max(len(starts), 1))
+
+    tasks = ((stream, min(block, N - start), region, cond_func, trace.within(start, min(block, N - start)) - start,
+              keep, chunk, bins if render == "density" else None) for stream, start in zip(streams, starts))
+
+    # The blocks come back in order, so the trace and the figures are built as they finish
+    tenth = max(N // 10, 1)
+    hits = 0
+    samples = []
+    density = DensityMap(region, bins)
+    figure = None
+    with multiprocessing.Pool(workers) as pool:
+        for start, (block_hits, counts, kept) in zip(starts, pool.imap(sample_block, tasks)):
+            size = min(block, N - start)
+            trace.add(trace.within(start, size), hits + counts, scaling_func)
+            hits += block_hits
+            if render == "density":
+                density.merge(kept)
+            else:
+                samples.append(kept)
+
+            if plot and render == "density" and (start + size) // tenth > start // tenth:
+                figure = figure or DensityFigure(region, target, target_name)
+                figure.update(density, trace.results, trace.iterations)
+            elif plot and (start + size) // tenth > start // tenth:
+                x, y, inside = (np.concatenate(part) for part in zip(*samples))
+                create_fig(x[inside], x[~inside], y[inside], y[~inside], trace.results, target, target_name,
+                           trace.iterations)
 
-    # Array for the results
+    # At the end print the results
+    estimate, error = scaling_func(hits / N), fraction_error(hits / N, N, scaling_func)
+    print(f"The approximation to {target_name} for {N} points is {estimate} +- {error}")
+    print(f"The actual value of {target_name} is {target}")
+    return estimate, error, N
+
+
+# Standard error of a fraction of hits out of N points, carried through the scaling
+def fraction_error(fraction, N, scaling_func):
+    spread = math.sqrt(fraction * (1 - fraction) / N)
+    return abs(scaling_func(fraction + spread) - scaling_func(fraction))
+
+
+# Monte Carlo simulation with a sampling method, run in batches of points that are each an
+# independent estimate of the fraction, so that the spread of the batches gives the standard error.
+# With a tolerance the run stops as soon as the confidence interval is narrower than it, N is then
+# the most points that will be used. Importance sampling draws x from a linear density going from
+# importance[0] to importance[1] over the region and averages the height of the curve at x, given by
+# height, times the weight of x. Hits under the curve would not gain anything from the density, as
+# the chance of a hit at x is already the height there
+def monte_carlo_batches(N, region, cond_func, scaling_func, target, target_name, method="uniform", batch=2 ** 16,
+                        seed=None, plot=True, tolerance=None, confidence=0.95, importance=(1, 1), min_batches=10,
+                        render="scatter", bins=256, height=None):
+    if method == "importance" and height is None:
+        raise ValueError("Importance sampling needs the height of the curve")
+    rng = np.random.default_rng(seed)
+    sampler = SAMPLERS[method]
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+
+    fractions = []
+    sizes = []
+    iterations = []
     results = []
+    tenth = max(N // 10, 1)
+    used = 0
+    error = math.inf
+    density = DensityMap(region, bins)
+    figure = None
+
+    while used < N:
+        u, v = sampler(min(batch, N - used), rng)
+        weight = 1
+        if method == "importance":
+            u, weight = linear_density(u, *importance)
 
-    # Generate N points
-    for i in range(N):
         # In the described region
-        x = random.uniform(region[0][0], region[0][1])
-        y = random.uniform(region[1][0], region[1][1])
-
-        # Check that the point is under the curve
-        cond = cond_func(x, y)
-        # If it is
-        if cond <= 1:
-            # Add it to the inner points
-            xi.append(x)
-            yi.append(y)
-        # Else add it to the outer points
+        x = region[0][0] + (region[0][1] - region[0][0]) * u
+        y = region[1][0] + (region[1][1] - region[1][0]) * v
+        inside = cond_func(x, y) <= 1
+        if render == "density":
+            density.add(x, y, inside)
+
+        # The points are still drawn under the curve for the figures
+        if method == "importance":
+            heights = np.clip((height(x) - region[1][0]) / (region[1][1] - region[1][0]), 0, 1)
+            fractions.append(float(np.mean(heights * weight)))
         else:
-            xo.append(x)
-            yo.append(y)
-
-        # Get the fraction of the points that are under the curve
-        fraction_in = len(xi) / (i + 1)
+            fractions.append(float(np.mean(inside)))
+        sizes.append(len(x))
+        start, used = used, used + len(x)
+
+        # The fraction is the mean of the batches weighted by their size, its standard error comes
+        # from their spread, which is then carried through the scaling
+        fraction = np.average(fractions, weights=sizes)
+        estimate = scaling_func(fraction)
+        if len(fractions) > 1:
+            spread = np.sqrt(np.average((np.array(fractions) - fraction) ** 2, weights=sizes) / (len(fractions) - 1))
+            error = abs(scaling_func(fraction + spread) - estimate)
+        iterations.append(used)
+        results.append(estimate)
+
+        # If the batch passed a tenth of the way through plot the graphs
+        if plot and render == "density" and used // tenth > start // tenth:
+            figure = figure or DensityFigure(region, target, target_name)
+            figure.update(density, results, iterations)
+        elif plot and used // tenth > start // tenth:
+            create_fig(x[inside], x[~inside], y[inside], y[~inside], results, target, target_name, iterations)
+
+        # Stop once the confidence interval is within the tolerance
+        if tolerance is not None and len(fractions) >= min_batches and z * error <= tolerance:
+            break
 
-        # Scale the fraction of areas to get the desired value and
-        # Add it to the list of results
-        results.append(scaling_func(fraction_in))
+    # At the end print the results
+    print(f"The approximation to {target_name} for {used} points is {estimate} +- {z * error} "
+          f"({confidence:.0%} confidence, {method} sampling)")
+    print(f"The actual value of {target_name} is {target}")
+    return estimate, error, used
+
+
+# Monte Carlo simulation method. By default every point and the result after every point are kept,
+# in streaming mode only the hit count, a log-spaced trace and a reservoir of points are, so the
+# memory used does not depend on N. Rendering a density map streams as well, it counts every point.
+# The estimate is returned with its standard error and the number of points used. The chunk, block,
+# reservoir and checkpoints default to 2 ** 20, 2 ** 22, 10000 and 1000 and only apply to uniform sampling
+def monte_carlo_sim(N, region, cond_func, scaling_func, target, target_name, chunk=None, seed=None, plot=True,
+                    streaming=False, reservoir=None, checkpoints=None, parallel=False, workers=None, block=None,
+                    method="uniform", tolerance=None, confidence=0.95, importance=(1, 1), render="scatter", bins=256,
+                    height=None):
+    # Other sampling methods and stopping at a tolerance need the points in independent batches. They
+    # run on one core and only keep one batch of points, so they always stream
+    if method != "uniform" or tolerance is not None:
+        if parallel or any(option is not None for option in (workers, chunk, reservoir, checkpoints, block)):
+            raise ValueError("Sampling methods and tolerances run in batches on one core, they take no workers, "
+                             "blocks, chunks, reservoir or checkpoints")
+        return monte_carlo_batches(N, region, cond_func, scaling_func, target, target_name, method, seed=seed,
+                                   plot=plot, tolerance=tolerance, confidence=confidence, importance=importance,
+                                   render=render, bins=bins, height=height)
+
+    chunk = 2 ** 20 if chunk is None else chunk
+    block = 2 ** 22 if block is None else block
+    reservoir = 10000 if reservoir is None else reservoir
+    checkpoints = 1000 if checkpoints is None else checkpoints
+
+    # The parallel simulation always streams
+    if parallel:
+        return monte_carlo_parallel(N, region, cond_func, scaling_func, target, target_name, workers, seed, block,
+                                    chunk, plot=plot, reservoir=reservoir, checkpoints=checkpoints, render=render,
+                                    bins=bins)
+
+    # The reservoir draws from its own stream so that both modes sample the same points for a seed
+    seeds = np.random.SeedSequence(seed)
+    rng = np.random.default_rng(seeds)
+
+    # Chunks of the location of points, and of whether they are inside the function
+    xs = []
+    ys = []
+    insides = []
+
+    # Chunks of the results
+    results = []
 
-        # If it is 1 tenth of the way through plot the graphs
-        if i % (N / 10) == 1:
-            create_fig(xi, xo, yi, yo, results, target, target_name)
+    # The streaming replacements
+    trace = ConvergenceTrace(N, checkpoints)
+    sample = Reservoir(reservoir, np.random.default_rng(seeds.spawn(1)[0]))
+    density = DensityMap(region, bins)
+    figure = None
+
+    # The figures are drawn every tenth of the way through
+    tenth = max(N // 10, 1)
+    hits = 0
+
+    for start, x, y, inside in sample_chunks(N, region, cond_func, chunk, rng):
+        # The running fraction of the points that are under the curve comes from the cumulative
+        # count of hits, scale it to get the desired value after every point
+        counts = hits + np.cumsum(inside)
+        hits = int(counts[-1])
+
+        if render == "density":
+            trace.record(start, counts, scaling_func)
+            density.add(x, y, inside)
+        elif streaming:
+            trace.record(start, counts, scaling_func)
+            sample.add(x, y, inside)
+        else:
+            xs.append(x)
+            ys.append(y)
+            insides.append(inside)
+            results.append(scaling_func(counts / np.arange(start + 1, start + len(x) + 1)))
+
+        # If the chunk passed a tenth of the way through plot the graphs
+        passed = plot and (start + len(x)) // tenth > start // tenth
+        if passed and render == "density":
+            figure = figure or DensityFigure(region, target, target_name)
+            figure.update(density, trace.results, trace.iterations)
+        elif passed and streaming:
+            create_fig(*sample.split(), trace.results, target, target_name, trace.iterations)
+        elif passed:
+            x, y, inside = np.concatenate(xs), np.concatenate(ys), np.concatenate(insides)
+            create_fig(x[inside], x[~inside], y[inside], y[~inside], np.concatenate(results), target, target_name)
 
     # At the end print the results
-    print(f"The approximation to {target_name} for {N} points is {results[-1]}")
+    estimate, error = scaling_func(hits / N), fraction_error(hits / N, N, scaling_func)
+    print(f"The approximation to {target_name} for {N} points is {estimate} +- {error}")
     print(f"The actual value of {target_name} is {target}")
+    return estimate, error, N
+
+
+# Result of an integration, the estimate with its standard error and how long it took
+class Integral:
+    def __init__(self, estimate, error, points, seconds):
+        self.estimate = estimate
+        self.error = error
+        self.points = points
+        self.seconds = seconds
+        self.points_per_second = points / seconds if seconds > 0 else math.inf
+
+    def __repr__(self):
+        return (f"Integral(estimate={self.estimate}, error={self.error}, points={self.points}, "
+                f"seconds={self.seconds:.3f})")
+
+
+# Integrate over one block of points from its own stream, giving back the sum and the sum of the
+# squares of the integrand, how many values went in and how many points they used. With antithetic
+# pairs every point comes with its reflection through the centre of the box and the value is the
+# mean of the pair, an odd size leaves out the reflection of the last point
+def integrate_block(task):
+    seed, size, box, integrand, antithetic, chunk = task
+    total = 0.0
+    squares = 0.0
+    count = 0
+    used = 0
+
+    drawn = -(-size // 2) if antithetic else size
+    for start, points in sample_box(drawn, box, chunk, np.random.default_rng(seed)):
+        values = np.asarray(integrand(points), dtype=float)
+        used += len(values)
+        if antithetic:
+            paired = len(values) - (start + len(values) == drawn and size % 2)
+            if paired:
+                reflected = np.asarray(integrand(box[:, 0] + box[:, 1] - points[:paired]), dtype=float)
+                values[:paired] = (values[:paired] + reflected) / 2
+            used += paired
+        total += float(np.sum(values))
+        squares += float(np.sum(values ** 2))
+        count += len(values)
+
+    return total, squares, count, used
+
+
+# Monte Carlo integration of a function over a box of any dimension. The integrand takes an array
+# of points of shape (size, dimensions) and gives a value for each, an indicator (bool) works as
+# well and gives the volume it covers. The integral of the box, scaled by scaling_func, is returned
+# with its standard error and timings. Like the parallel simulation the points are drawn in blocks
+# of a fixed size from streams spawned from the seed, so the result does not depend on the workers.
+# With a tolerance the integration stops after the first block where the confidence interval is
+# narrower than it, N is then the most points that will be used
+def integrate(integrand, box, N=10 ** 6, scaling_func=None, seed=None, workers=1, block=2 ** 22, chunk=2 ** 20,
+              antithetic=False, tolerance=None, confidence=0.95):
+    start_time = time.perf_counter()
+    box = np.asarray(box, dtype=float)
+    volume = float(np.prod(box[:, 1] - box[:, 0]))
+    scaling_func = scaling_func or (lambda value: value)
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+
+    starts = range(0, N, block)
+    streams = np.random.SeedSequence(seed).spawn(len(starts))
+    tasks = ((stream, min(block, N - start), box, integrand, antithetic, chunk) for stream, start in zip(streams, starts))
+
+    total = 0.0
+    squares = 0.0
+    count = 0
+    used = 0
+    estimate, error = math.nan, math.inf
+    pool = multiprocessing.Pool(workers) if workers != 1 else None
+    try:
+        for block_total, block_squares, block_count, block_used in (pool.imap if pool else map)(integrate_block,
+                                                                                                 tasks):
+            total += block_total
+            squares += block_squares
+            count += block_count
+            used += block_used
+
+            # The integral is the volume times the mean of the integrand, its standard error comes
+            # from the variance of the values, which is then carried through the scaling
+            mean = total / count
+            spread = volume * math.sqrt(max(squares / count - mean ** 2, 0) / max(count - 1, 1))
+            estimate = scaling_func(volume * mean)
+            error = abs(scaling_func(volume * mean + spread) - estimate)
+
+            if tolerance is not None and z * error <= tolerance:
+                break
+    finally:
+        if pool:
+            pool.terminate()
+
+    return Integral(estimate, error, used, time.perf_counter() - start_time)
+
+
+# The conditions are kept outside of the approximations so that they can be sent to other processes
+
+# The condition function will be checking that the point is inside the circle
+def pi_condition(x, y): return x ** 2 + y ** 2
+
+
+# The height of the curve at x
+def pi_height(x): return np.sqrt(np.clip(1 - x ** 2, 0, None))
+
+
+# The condition is that the point is bounded by the curve y = 1/x
+# Or y * x = 1
+def ln2_condition(x, y): return x * y
+
+
+# The height of the curve at x
+def ln2_height(x): return 1 / x
+
+
+# The condition is that the point is bounded by y = 1/sqrt(x) or
+# y * sqrt(x) = 1
+def sqrt2_condition(x, y): return np.sqrt(x) * y
+
+
+# The height of the curve at x
+def sqrt2_height(x): return 1 / np.sqrt(x)
 
 
 # Monte Carlo Pi Approximation
-def monte_carlo_pi(N):
+def monte_carlo_pi(N, **kwargs):
     # This uses the fact that the area of the unit circle is pi
     # Therefore the area of the quarter inside the unit square is pi/4
 
     # The wanted region is the one of the unit square (0,0), (0,1), (1,0), (1,1)
     region = [[0, 1], [0, 1]]
 
-    # The condition function will be checking that the point is inside the circle
-    def cond_func(x, y): return x ** 2 + y ** 2
-
     # And area fraction will be scaled by four to get pi
     def scaling_func(value): return 4 * value
 
+    # Importance sampling follows the height of the circle from 1, the line down to about a third
+    # is the closest to it over most of the quarter as it only falls to 0 at the very end
+    kwargs.setdefault("importance", (1, 0.34))
+
     # Run the simulation
-    monte_carlo_sim(N, region, cond_func, scaling_func, math.pi, "pi")
+    return monte_carlo_sim(N, region, pi_condition, scaling_func, math.pi, "pi", height=pi_height, **kwargs)
 
 
 # Monte Carlo Approximation for ln2
-def monte_carlo_ln2(N):
+def monte_carlo_ln2(N, **kwargs):
     # This was done independently, however clarify ability sqrt(2) was also done
     # This uses the fact that the integral of 1/x is ln(x)
     # Therefore the area going from x = 1 to x = 2 is ln2
@@ -121,19 +677,18 @@ def monte_carlo_ln2(N):
     # The region is as described above (1,0), (2,0), (1, 1), (2,1)
     region = [[1, 2], [0, 1]]
 
-    # The condition is that the point is bounded by the curve y = 1/x
-    # Or y * x = 1
-    def cond_func(x, y): return x * y
-
     # The scaling function is just 1
     def scaling_func(value): return value
 
+    # Importance sampling follows the height of the curve, from 1 down to 1/2
+    kwargs.setdefault("importance", (1, 0.5))
+
     # Run the simulation
-    monte_carlo_sim(N, region, cond_func, scaling_func, math.log(2), "ln2")
+    return monte_carlo_sim(N, region, ln2_condition, scaling_func, math.log(2), "ln2", height=ln2_height, **kwargs)
 
 
 # Monte Carlo Approximation for sqrt2
-def monte_carlo_sqrt2(N):
+def monte_carlo_sqrt2(N, **kwargs):
     # This uses the fact that the integral of 1/sqrt(x) is 2 * sqrt(x)
     # Therefore the area from x = 1 to x = 2 is 2 * sqrt(2) - 2
     # In this case the region is once again a unit square
@@ -141,49 +696,54 @@ def monte_carlo_sqrt2(N):
     # The region is as described before, (1,0), (2,0), (1,1), (2,1)
     region = [[1, 2], [0, 1]]
 
-    # The condition is that the point is bounded by y = 1/sqrt(x) or
-    # y * sqrt(x) = 1
-    def cond_func(x, y): return math.sqrt(x) * y
-
     # The scaling function is simply solving for the sqrt(2) from the result of the integral
     def scaling_func(value): return (0.5 * value) + 1
 
-    # Run the simulation
-    monte_carlo_sim(N, region, cond_func, scaling_func, math.sqrt(2), "sqrt2")
+    # Importance sampling follows the height of the curve, from 1 down to 1/sqrt(2)
+    kwargs.setdefault("importance", (1, 0.71))
 
+    # Run the simulation
+    return monte_carlo_sim(N, region, sqrt2_condition, scaling_func, math.sqrt(2), "sqrt2", height=sqrt2_height,
+                           **kwargs)
+
+
+# Run program, the workers of the parallel simulation import this file without running it
+if __name__ == "__main__":
+    # Describe the purpose of the program
+    print("-------Monte Carlo Approximation------")
+    print("\nThe purpose of this program is to run a monte carlo approximation for some values")
+    print("\nThis program can currently simulate: \n(1) Pi\n(2) ln(2)\n(3) sqrt(2)\n")
+
+    # Get which simulation to run
+    sim = -1
+    while not(0 < sim < 4):
+        try:
+            sim = int(input("What number should be approximated: "))
+            if 1 > sim or sim > 3:
+                raise ValueError
+
+        except ValueError:
+            print("Please enter an integer between 1 and 3")
+
+    # Get how many points should be used
+    N = -1
+    while N < 0:
+        try:
+            N = int(input("How many random points should be used, (above 10000000 only a sample of the points is kept and every core is used): "))
+            if N < 0:
+                raise ValueError
+
+        except ValueError:
+            print("Please enter an integer larger the 0")
+
+    # Past a million points the points are drawn as a density map rather than one by one
+    render = "density" if N > 10 ** 6 else "scatter"
 
-# Describe the purpose of the program
-print("-------Monte Carlo Approximation------")
-print("\nThe purpose of this program is to run a monte carlo approximation for some values")
-print("\nThis program can currently simulate: \n(1) Pi\n(2) ln(2)\n(3) sqrt(2)\n")
-
-# Get which simulation to run
-sim = -1
-while not(0 < sim < 4):
-    try:
-        sim = int(input("What number should be approximated: "))
-        if 1 > sim or sim > 3:
-            raise ValueError
-
-    except ValueError:
-        print("Please enter an integer between 1 and 3")
-
-# Get how many points should be used
-N = -1
-while N < 0:
-    try:
-        N = int(input("How many random points should be used, (for reference 10000000 may not run on a laptop): "))
-        if N < 0:
-            raise ValueError
-
-    except ValueError:
-        print("Please enter an integer larger the 0")
-
-# Run the simulation
-print("Beginning approximation")
-match sim:
-    case 1: monte_carlo_pi(N)
-    case 2: monte_carlo_ln2(N)
-    case 3: monte_carlo_sqrt2(N)
+    # Run the simulation
+    print("Beginning approximation")
+    match sim:
+        case 1: monte_carlo_pi(N, streaming=N > 10 ** 7, parallel=N > 10 ** 7, render=render)
+        case 2: monte_carlo_ln2(N, streaming=N > 10 ** 7, parallel=N > 10 ** 7, render=render)
+        case 3: monte_carlo_sqrt2(N, streaming=N > 10 ** 7, parallel=N > 10 ** 7, render=render)
 
-input()
+    input()
\ No newline at end of file
@@ -0,0 +1,119 @@
+import argparse
+import contextlib
+import io
+import json
+import math
+import time
+import tracemalloc
+from itertools import product
+
+from MonteCarlo import monte_carlo_pi, monte_carlo_ln2, monte_carlo_sqrt2, SAMPLERS
+
+# The estimators and the values they approximate
+TARGETS = {
+    "pi": (monte_carlo_pi, math.pi),
+    "ln2": (monte_carlo_ln2, math.log(2)),
+    "sqrt2": (monte_carlo_sqrt2, math.sqrt(2)),
+}
+
+
+# Runs one estimate headless and silently, giving it with the number of points it used. The uniform
+# method streams, on one core with no workers or split into the blocks of the parallel simulation,
+# whose estimates are the same for any number of workers. The other methods run in batches on one core
+def estimate(target, points, method, workers, seed):
+    function = TARGETS[target][0]
+    options = {"seed": seed, "plot": False}
+    if method == "uniform":
+        options.update(streaming=True, parallel=workers > 0, workers=workers)
+    else:
+        options.update(method=method)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        value, error, used = function(points, **options)
+    return float(value), used
+
+
+def peak_memory(target, points, method, workers, seed):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    estimate(target, points, method, workers, seed)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+# Runs one configuration a number of times with different seeds and reports its throughput, memory
+# and the error of the estimates against the exact value. The throughput counts the points that the
+# estimates used rather than the ones asked for
+def run_case(target, points, method, workers, repeats, seed, memory_points):
+    exact = TARGETS[target][1]
+    estimates = []
+    used = []
+    seconds = []
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        value, count = estimate(target, points, method, workers, seed + repeat)
+        seconds.append(time.perf_counter() - start)
+        estimates.append(value)
+        used.append(count)
+
+    errors = [abs(value - exact) for value in estimates]
+    return {
+        "target": target,
+        "points": points,
+        "points_used": used,
+        "method": method,
+        "workers": workers,
+        "repeats": repeats,
+        "seed": seed,
+        "exact": exact,
+        "estimates": estimates,
+        "absolute_errors": errors,
+        "mean_absolute_error": sum(errors) / repeats,
+        "rms_error": math.sqrt(sum(error ** 2 for error in errors) / repeats),
+        "seconds": seconds,
+        "points_per_second": sum(used) / sum(seconds),
+        # Only the memory of this process is traced, not the one of the workers
+        "peak_memory_bytes": peak_memory(target, memory_points, method, workers, seed),
+        "memory_points": memory_points,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the Monte Carlo estimators over a parameter matrix")
+    parser.add_argument("--target", nargs="+", default=list(TARGETS), choices=list(TARGETS))
+    parser.add_argument("--points", nargs="+", type=int, default=[10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7])
+    parser.add_argument("--method", nargs="+", default=["uniform", "stratified", "sobol"], choices=list(SAMPLERS))
+    parser.add_argument("--workers", nargs="+", type=int, default=[0],
+                        help="worker processes of the uniform method, 0 runs it without any")
+    parser.add_argument("--repeats", type=int, default=5, help="seeds per configuration")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first repeat")
+    parser.add_argument("--memory-points", type=int, default=10 ** 6)
+    parser.add_argument("--output", default="montecarlo_benchmark.jsonl")
+    args = parser.parse_args()
+
+    # The parallel estimates must be the same for any number of workers, so those of every worker
+    # count are checked against the first one run for the same target and points
+    reference = {}
+
+    with open(args.output, "a") as file:
+        for target, points, method, workers in product(args.target, args.points, args.method, args.workers):
+            # The other methods do not use the workers, so they are only run once
+            if method != "uniform" and workers != args.workers[0]:
+                continue
+
+            result = run_case(target, points, method, workers, args.repeats, args.seed, args.memory_points)
+            if method == "uniform" and workers > 0:
+                first, estimates = reference.setdefault((target, points), (workers, result["estimates"]))
+                result["compared_with_workers"] = first
+                result["reproducible"] = result["estimates"] == estimates
+
+            file.write(json.dumps(result) + "\n")
+            file.flush()
+
+            print(f"{target:>5} N={points} {method:>10} workers={workers}: "
+                  f"{result['points_per_second']:.3g} points/s, "
+                  f"rms error {result['rms_error']:.3e}, "
+                  f"peak {result['peak_memory_bytes'] / 2 ** 20:.1f}MiB")
+            if not result.get("reproducible", True):
+                print(f"      the estimates differ from the ones with workers={result['compared_with_workers']}")
\ No newline at end of file
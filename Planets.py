@@ -1,12 +1,20 @@
 # Importing useful functions for the program
+import argparse
 import random
+import struct
+import threading
+import time
+from collections import deque
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 from numpy import linalg as la
 
-# Used to create an easy to use gui for the program
-import PySimpleGUI as gui
+# Used to create an easy to use gui for the program, it is not needed to run headless
+try:
+    import PySimpleGUI as gui
+except ImportError:
+    gui = None
 
 
 # Implementing Euler Solving Method
@@ -36,6 +44,136 @@ def leap_frog_solving(x, v, t, F, m, dt):
     return x, v, t
 
 
+# Implementing velocity verlet solving method. The acceleration at the end of a step is the one at
+# the start of the next, so it is kept and the forces are evaluated once per step. It is worked out
+# again when the positions are not the ones it was kept for, or after reset when the forces changed
+class VerletSolving:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.position = None
+        self.acceleration = None
+
+    def __call__(self, x, v, t, F, m, dt):
+        # Full step of the position with the current acceleration
+        if self.position is None or self.position.shape != x.shape or not np.array_equal(self.position, x):
+            self.acceleration = F(x) / m
+        x += dt * v + 1 / 2 * dt ** 2 * self.acceleration
+
+        # Update the velocity with the average of both accelerations
+        acceleration = F(x) / m
+        v += 1 / 2 * dt * (self.acceleration + acceleration)
+        self.position, self.acceleration = x.copy(), acceleration
+        t += dt
+        return x, v, t
+
+
+# Implementing the classical 4th order Runge-Kutta solving method
+def rk4_solving(x, v, t, F, m, dt):
+    # The four slopes of the position and velocity
+    a1 = F(x) / m
+    a2 = F(x + 1 / 2 * dt * v) / m
+    a3 = F(x + 1 / 2 * dt * v + 1 / 4 * dt ** 2 * a1) / m
+    a4 = F(x + dt * v + 1 / 2 * dt ** 2 * a2) / m
+
+    # Weighted step
+    x += dt * v + dt ** 2 / 6 * (a1 + a2 + a3)
+    v += dt / 6 * (a1 + 2 * a2 + 2 * a3 + a4)
+    t += dt
+    return x, v, t
+
+
+# Implementing the 4th order Yoshida solving method, three leapfrog like drifts and kicks
+# with weights chosen so that the errors of the lower orders cancel
+def yoshida_solving(x, v, t, F, m, dt):
+    w1 = 1 / (2 - 2 ** (1 / 3))
+    w0 = -2 ** (1 / 3) * w1
+    drifts = (w1 / 2, (w0 + w1) / 2, (w0 + w1) / 2, w1 / 2)
+    kicks = (w1, w0, w1)
+
+    for i in range(3):
+        x += drifts[i] * dt * v
+        v += kicks[i] * dt * F(x) / m
+    x += drifts[3] * dt * v
+
+    t += dt
+    return x, v, t
+
+
+# Implementing an adaptive Dormand-Prince 5(4) solving method. The step dt is covered in as
+# many internal steps as the error control needs, so close encounters get small steps and quiet
+# stretches large ones, and the last step size is remembered for the next call
+class AdaptiveSolving:
+    # Butcher table of the Dormand-Prince method, the 5th order weights are the last row of a
+    a = [[],
+         [1 / 5],
+         [3 / 40, 9 / 40],
+         [44 / 45, -56 / 15, 32 / 9],
+         [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729],
+         [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656],
+         [35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84]]
+    error = [71 / 57600, 0, -71 / 16695, 71 / 1920, -17253 / 339200, 22 / 525, -1 / 40]
+
+    def __init__(self, tolerance=1e-6, min_step=1e-12):
+        self.tolerance = tolerance
+        self.min_step = min_step
+        self.step = None
+        self.evaluations = 0
+        self.rejected = 0
+
+    def __call__(self, x, v, t, F, m, dt):
+        end = t + dt
+        h = dt if self.step is None else min(self.step, dt)
+
+        while end - t > 1e-12 * abs(dt):
+            h = min(h, end - t)
+
+            # Slopes of the position (the velocity) and of the velocity (the acceleration)
+            kx, kv = [], []
+            for row in self.a:
+                xs = x + h * sum(c * k for c, k in zip(row, kx))
+                vs = v + h * sum(c * k for c, k in zip(row, kv))
+                kx.append(vs)
+                kv.append(F(xs) / m)
+            self.evaluations += len(self.a)
+
+            # The last stage is the 5th order solution, the error is its difference with the 4th order one
+            error_x = h * sum(c * k for c, k in zip(self.error, kx))
+            error_v = h * sum(c * k for c, k in zip(self.error, kv))
+            new_x = x + h * sum(c * k for c, k in zip(self.a[-1], kx))
+            new_v = v + h * sum(c * k for c, k in zip(self.a[-1], kv))
+            error = max(np.max(np.abs(error_x) / (self.tolerance * (1 + np.abs(new_x)))),
+                        np.max(np.abs(error_v) / (self.tolerance * (1 + np.abs(new_v)))))
+
+            if error <= 1 or h <= self.min_step:
+                x, v, t = new_x, new_v, t + h
+            else:
+                self.rejected += 1
+
+            h = max(h * min(5.0, max(0.2, 0.9 * (error + 1e-300) ** (-1 / 5))), self.min_step)
+
+        self.step = h
+        return x, v, t
+
+
+# Registry of the solving methods, all take the state (x, v, t, F, m, dt)
+SOLVERS = {
+    "euler": euler_solving,
+    "leapfrog": leap_frog_solving,
+    "verlet": VerletSolving,
+    "rk4": rk4_solving,
+    "yoshida": yoshida_solving,
+    "adaptive": AdaptiveSolving,
+}
+
+
+# Create the solving method registered under a name, methods with a state get their own instance
+def make_solver(name):
+    solver = SOLVERS[name]
+    return solver() if isinstance(solver, type) else solver
+
+
 # General Forcing equation
 def force(position, source, coefficient, power, propriety, propriety_source):
     forcing = coefficient * (position - source)
@@ -44,11 +182,467 @@ def force(position, source, coefficient, power, propriety, propriety_source):
     return forcing
 
 
+# Mask of which bodies act on which, objects sharing a non-zero interaction space ignore each other
+def interaction_mask(spaces_on, spaces_from):
+    spaces_on = spaces_on[..., :, None]
+    spaces_from = spaces_from[..., None, :]
+    return (spaces_on == 0) | (spaces_from == 0) | (spaces_on != spaces_from)
+
+
+# Distance used in the force law, the softening length keeps close encounters finite
+def softened(distance, softening):
+    return np.sqrt(distance ** 2 + softening ** 2) if softening else distance
+
+
+# Vectorised version of the force function, the total force on every body at positions
+# from every other body at sources. An ensemble of M systems is given as (M, N, 2) positions
+# with a coefficient and power per member. The rows are computed in blocks of at most block
+# pairs over all members to bound the memory used
+def forces(positions, sources, masses, spaces, mapping, block=2 ** 18, softening=0):
+    single = np.ndim(positions) == 2
+    if single:
+        positions, sources, masses, spaces = positions[None], sources[None], masses[None], spaces[None]
+    coefficient, power = (np.reshape(value, (-1, 1, 1)) for value in mapping)
+    members, count = positions.shape[:2]
+    total = np.zeros(positions.shape)
+    rows_per_block = max(1, block // (members * sources.shape[1]))
+
+    for start in range(0, count, rows_per_block):
+        rows = slice(start, start + rows_per_block)
+        separation = positions[:, rows, None, :] - sources[:, None, :, :]
+        distance = la.norm(separation, axis=3)
+
+        # Bodies do not act on themselves, and coincident bodies have no defined direction
+        mask = interaction_mask(spaces[:, rows], spaces) & (distance > 0)
+        mask[:, np.arange(distance.shape[1]), np.arange(start, start + distance.shape[1])] = False
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scale = np.where(mask, coefficient * softened(np.where(mask, distance, 1), softening) ** (power - 1), 0)
+        scale *= masses[:, rows, None] * masses[:, None, :]
+        total[:, rows] = np.einsum("mij,mijk->mik", scale, separation)
+
+    return total[0] if single else total
+
+
+# Spread the bits of a 32 bit integer so that two of them can be interleaved
+def spread_bits(v):
+    v = v.astype(np.uint64) & np.uint64(0xFFFFFFFF)
+    for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333), (1, 0x5555555555555555)):
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+# Quadtree over a set of sources, built level by level from the sorted Morton codes of the
+# sources so that every node is a contiguous run of bodies. Each level stores the code prefix,
+# the range of bodies, the total mass and the centre of mass of its nodes
+class QuadTree:
+    def __init__(self, sources, masses, levels=20):
+        self.levels = levels
+        self.sources = sources
+        lower = sources.min(axis=0)
+        self.size = max(float((sources.max(axis=0) - lower).max()), 1e-12) * (1 + 1e-9)
+
+        cells = np.clip(((sources - lower) / self.size * 2 ** levels).astype(np.int64), 0, 2 ** levels - 1)
+        codes = spread_bits(cells[:, 0]) | (spread_bits(cells[:, 1]) << np.uint64(1))
+        self.order = np.argsort(codes, kind="stable")
+        self.codes = codes
+        sorted_codes = codes[self.order]
+        sorted_masses = masses[self.order]
+        sorted_sources = sources[self.order]
+
+        self.nodes = []
+        for level in range(levels + 1):
+            prefix = sorted_codes >> np.uint64(2 * (levels - level))
+            starts = np.flatnonzero(np.r_[True, prefix[1:] != prefix[:-1]])
+            ends = np.r_[starts[1:], len(prefix)]
+
+            mass = np.add.reduceat(sorted_masses, starts)
+            weighted = np.add.reduceat(sorted_masses[:, None] * sorted_sources, starts)
+            centre = np.add.reduceat(sorted_sources, starts) / (ends - starts)[:, None]
+            centre = np.divide(weighted, mass[:, None], out=centre, where=mass[:, None] != 0)
+
+            self.nodes.append((prefix[starts], starts, ends, mass, centre))
+
+            # Once every body has its own node the deeper levels are all the same
+            if len(starts) == len(prefix):
+                break
+
+
+# Barnes-Hut walk of a tree for every body at once. The bodies are evaluated at positions but
+# body i is source i of the tree, so it never acts on itself. A node is used as a whole when it
+# does not hold the body and its size is below theta times its distance, or it is a single body.
+# Every level yields the bodies, the masses acting on them, their separations and distances
+def tree_interactions(tree, positions, masses, theta):
+    body = np.arange(len(positions))
+    node = np.zeros(len(positions), dtype=np.int64)
+
+    for level, (prefix, starts, ends, mass, centre) in enumerate(tree.nodes):
+        size = tree.size / 2 ** level
+        separation = positions[body] - centre[node]
+        distance = la.norm(separation, axis=1)
+        contains = (tree.codes[body] >> np.uint64(2 * (tree.levels - level))) == prefix[node]
+        single = ends[node] - starts[node] == 1
+
+        accept = ~contains & ((size < theta * distance) | single) & (distance > 0)
+        yield body[accept], mass[node[accept]], separation[accept], distance[accept]
+
+        opened = ~accept & ~single
+        body, node = body[opened], node[opened]
+        if not len(body):
+            break
+
+        if level == len(tree.nodes) - 1:
+            # Bodies that share the deepest cell are summed directly
+            counts = ends[node] - starts[node]
+            inner = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            other = tree.order[np.repeat(starts[node], counts) + inner]
+            body = np.repeat(body, counts)
+            keep = other != body
+            body, other = body[keep], other[keep]
+
+            separation = positions[body] - tree.sources[other]
+            distance = la.norm(separation, axis=1)
+            near = distance > 0
+            yield body[near], masses[other[near]], separation[near], distance[near]
+            break
+
+        # Open the node into its children on the next level
+        next_prefix = tree.nodes[level + 1][0] >> np.uint64(2)
+        first = np.searchsorted(next_prefix, prefix[node], side="left")
+        counts = np.searchsorted(next_prefix, prefix[node], side="right") - first
+        inner = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        body = np.repeat(body, counts)
+        node = np.repeat(first, counts) + inner
+
+
+def tree_forces(tree, positions, masses, mapping, theta, softening=0):
+    coefficient, power = mapping
+    total = np.zeros_like(positions, dtype=float)
+    for body, mass, separation, distance in tree_interactions(tree, positions, masses, theta):
+        scale = coefficient * softened(distance, softening) ** (power - 1) * masses[body] * mass
+        np.add.at(total, body, scale[:, None] * separation)
+    return total
+
+
+# Every pair is seen from both of its bodies, so half the sum is the potential energy
+def tree_energy(tree, positions, masses, mapping, theta, softening=0):
+    total = 0.0
+    for body, mass, separation, distance in tree_interactions(tree, positions, masses, theta):
+        total += float(np.sum(pair_energy(softened(distance, softening), mapping) * masses[body] * mass))
+    return total / 2
+
+
+# Potential energy of pairs of bodies at a distance, the integral of the force law
+def pair_energy(distance, mapping):
+    coefficient, power = mapping
+    if power == -1:
+        return -coefficient * np.log(distance)
+    return -coefficient * distance ** (power + 1) / (power + 1)
+
+
+# Potential energy of every interacting pair for the general forcing equation, the force
+# c r^power m1 m2 comes from -c m1 m2 r^(power + 1) / (power + 1), or -c m1 m2 ln(r) for power -1.
+# Pairs further apart than the cutoff do not interact, so they hold no energy either
+def potential_energy(positions, masses, spaces, mapping, block=512, softening=0, cutoff=None):
+    total = 0.0
+
+    for start in range(0, len(positions), block):
+        rows = slice(start, start + block)
+        distance = la.norm(positions[rows, None, :] - positions[None, :, :], axis=2)
+
+        # Every pair is only counted once
+        mask = interaction_mask(spaces[rows], spaces) & (distance > 0)
+        mask &= np.arange(len(positions))[None, :] > np.arange(start, start + len(distance))[:, None]
+        if cutoff is not None:
+            mask &= distance < cutoff
+
+        energy = pair_energy(softened(np.where(mask, distance, 1), softening), mapping)
+        total += float(np.sum(np.where(mask, energy, 0) * masses[rows, None] * masses[None, :]))
+
+    return total
+
+
+def kinetic_energy(velocities, masses):
+    return 0.5 * float(np.sum(masses * np.sum(velocities ** 2, axis=1)))
+
+
+def linear_momentum(velocities, masses):
+    return np.sum(masses[:, None] * velocities, axis=0)
+
+
+def angular_momentum(positions, velocities, masses):
+    return float(np.sum(masses * (positions[:, 0] * velocities[:, 1] - positions[:, 1] * velocities[:, 0])))
+
+
+# Conservation diagnostics of a simulation. Momentum and angular momentum cost O(N) and are taken
+# every step, the energy costs as much as the forces so it is only taken every interval steps.
+# Only the last history energies are kept, the drift is measured from the first one
+class Diagnostics:
+    def __init__(self, interval=10, history=1000):
+        self.interval = interval
+        self.steps = 0
+        self.times = deque(maxlen=history)
+        self.energies = deque(maxlen=history)
+        self.initial_energy = None
+        self.momentum = None
+        self.angular_momentum = None
+        self.initial_momentum = None
+        self.initial_angular_momentum = None
+
+    def observe(self, simulation):
+        self.momentum = linear_momentum(simulation.velocities, simulation.masses)
+        self.angular_momentum = angular_momentum(simulation.positions, simulation.velocities, simulation.masses)
+        if self.initial_momentum is None:
+            self.initial_momentum = self.momentum
+            self.initial_angular_momentum = self.angular_momentum
+
+        if self.steps % self.interval == 0:
+            self.times.append(simulation.time)
+            self.energies.append(simulation.energy())
+            if self.initial_energy is None:
+                self.initial_energy = self.energies[0]
+        self.steps += 1
+
+    # Relative drift of the energy, momentum and angular momentum since the first observation
+    def drift(self):
+        if not self.energies:
+            return {}
+        return {
+            "energy": abs(self.energies[-1] - self.initial_energy) / max(abs(self.initial_energy), 1e-300),
+            "momentum": float(la.norm(self.momentum - self.initial_momentum) /
+                              max(la.norm(self.initial_momentum), 1e-300)),
+            "angular_momentum": abs(self.angular_momentum - self.initial_angular_momentum) /
+                                max(abs(self.initial_angular_momentum), 1e-300),
+        }
+
+
+# Counters of the time spent in every part of a step
+class Profiler:
+    def __init__(self):
+        self.totals = {}
+        self.counts = {}
+
+    def add(self, name, seconds):
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    # Mean milliseconds per step of every part, integration is the step without the forces
+    def means(self):
+        means = {name: 1000 * self.totals[name] / self.counts[name] for name in self.totals}
+        if "step" in self.totals:
+            means["integration"] = 1000 * (self.totals["step"] - self.totals.get("forces", 0.0)) / self.counts["step"]
+            means["forces"] = 1000 * self.totals.get("forces", 0.0) / self.counts["step"]
+        return means
+
+    def report(self):
+        return ", ".join(f"{name} {value:.3f}ms" for name, value in self.means().items())
+
+
+# Barnes-Hut version of the forces function for inverse power laws. Objects sharing a non-zero
+# interaction space ignore each other, so their own tree is walked and taken away from the total
+def barnes_hut_forces(positions, sources, masses, spaces, mapping, theta=0.5, softening=0):
+    if mapping[1] >= 0:
+        raise ValueError("The Barnes-Hut approximation needs an inverse power law (power < 0)")
+
+    total = tree_forces(QuadTree(sources, masses), positions, masses, mapping, theta, softening)
+    for space in np.unique(spaces[spaces != 0]):
+        members = np.flatnonzero(spaces == space)
+        if len(members) > 1:
+            total[members] -= tree_forces(QuadTree(sources[members], masses[members]), positions[members],
+                                          masses[members], mapping, theta, softening)
+
+    return total
+
+
+# Barnes-Hut version of the potential energy, with the same trees as the forces
+def barnes_hut_energy(positions, masses, spaces, mapping, theta=0.5, softening=0):
+    total = tree_energy(QuadTree(positions, masses), positions, masses, mapping, theta, softening)
+    for space in np.unique(spaces[spaces != 0]):
+        members = np.flatnonzero(spaces == space)
+        if len(members) > 1:
+            total -= tree_energy(QuadTree(positions[members], masses[members]), positions[members],
+                                 masses[members], mapping, theta, softening)
+    return total
+
+
+# Verlet neighbour list for short range force laws. Bodies are binned into a uniform grid of cells
+# the size of the cutoff plus a skin, so every pair within that range is in the same or a
+# neighbouring cell. The list is only rebuilt once some body has moved more than half the skin
+# since the last build, before then no pair can have come within the cutoff unseen
+class NeighbourList:
+    # Half of the neighbouring cells, the other half is found from the other side
+    offsets = ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1))
+
+    def __init__(self, cutoff, skin=None):
+        self.cutoff = cutoff
+        self.skin = 0.2 * cutoff if skin is None else skin
+        self.reference = None
+        self.first = np.zeros(0, dtype=np.int64)
+        self.second = np.zeros(0, dtype=np.int64)
+        self.builds = 0
+
+    def update(self, positions, spaces):
+        if self.reference is None or len(self.reference) != len(positions) or \
+                np.max(np.sum((positions - self.reference) ** 2, axis=1)) > (self.skin / 2) ** 2:
+            self.build(positions, spaces)
+        return self.first, self.second
+
+    def build(self, positions, spaces):
+        size = self.cutoff + self.skin
+        cells = np.floor((positions - positions.min(axis=0)) / size).astype(np.int64)
+
+        # One past the highest row so that the cell below the first row never wraps onto a used one
+        width = int(cells[:, 1].max()) + 2
+        keys = cells[:, 0] * width + cells[:, 1]
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+
+        first, second = [], []
+        for dx, dy in self.offsets:
+            target = keys + dx * width + dy
+            lower = np.searchsorted(sorted_keys, target, side="left")
+            counts = np.searchsorted(sorted_keys, target, side="right") - lower
+            inner = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            body = np.repeat(np.arange(len(positions)), counts)
+            other = order[np.repeat(lower, counts) + inner]
+
+            # Within a cell every pair is seen twice, keep it once
+            keep = other > body if (dx, dy) == (0, 0) else np.ones(len(body), dtype=bool)
+            first.append(body[keep])
+            second.append(other[keep])
+
+        first, second = np.concatenate(first), np.concatenate(second)
+        near = np.sum((positions[first] - positions[second]) ** 2, axis=1) < size ** 2
+        near &= (spaces[first] == 0) | (spaces[second] == 0) | (spaces[first] != spaces[second])
+        self.first, self.second = first[near], second[near]
+        self.reference = positions.copy()
+        self.builds += 1
+
+
+# Force on every body from the pairs of a neighbour list closer than the cutoff, every pair is
+# evaluated once and acts equally and oppositely on both bodies
+def cutoff_forces(positions, masses, mapping, neighbours, cutoff, softening=0):
+    coefficient, power = mapping
+    first, second = neighbours
+    separation = positions[first] - positions[second]
+    distance = la.norm(separation, axis=1)
+    near = (distance < cutoff) & (distance > 0)
+    first, second, separation = first[near], second[near], separation[near]
+
+    scale = coefficient * softened(distance[near], softening) ** (power - 1) * masses[first] * masses[second]
+    pair = scale[:, None] * separation
+    total = np.zeros_like(positions, dtype=float)
+    np.add.at(total, first, pair)
+    np.add.at(total, second, -pair)
+    return total
+
+
+# Potential energy of the pairs of a neighbour list closer than the cutoff
+def cutoff_energy(positions, masses, mapping, neighbours, cutoff, softening=0):
+    first, second = neighbours
+    distance = la.norm(positions[first] - positions[second], axis=1)
+    near = (distance < cutoff) & (distance > 0)
+    energy = pair_energy(softened(distance[near], softening), mapping)
+    return float(np.sum(energy * masses[first[near]] * masses[second[near]]))
+
+
+# Fixed size ring buffer holding the most recent positions of an object
+class Trail:
+    def __init__(self, capacity, dim=2):
+        self.data = np.zeros((capacity, dim))
+        self.capacity = capacity
+        self.size = 0
+        self.start = 0
+
+    # Add a position, overwriting the oldest one once the buffer is full
+    def append(self, position):
+        self.data[(self.start + self.size) % self.capacity] = position
+        if self.size < self.capacity:
+            self.size += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+
+    # The stored positions from the oldest to the newest
+    def array(self):
+        end = self.start + self.size
+        if end <= self.capacity:
+            return self.data[self.start:end]
+        return np.vstack([self.data[self.start:], self.data[:end - self.capacity]])
+
+    def clear(self):
+        self.size = 0
+        self.start = 0
+
+
+# Random initial conditions as set up by the gui, either every object at the same position with
+# different velocities or the other way round, plus the central planet at rest at the origin
+def random_setup(num_of_objects, on_pos=True, random_mass=True, interacting=True, central_mass=10000):
+    interaction = 1
+    if interacting:
+        interaction = 0
+
+    positions, velocities, masses, spaces = [], [], [], []
+    constant = np.random.randn(2) * 100
+    for i in range(num_of_objects):
+        variable = np.random.randn(2) * 100
+        if random_mass:
+            masses.append(random.randrange(1, 1000) / 10.0)
+        else:
+            masses.append(1)
+        if on_pos:
+            variable = (variable / (np.sum(variable ** 2) ** (1 / 2)) * 1000)
+            positions.append(np.copy(constant))
+            velocities.append(np.copy(variable))
+        else:
+            positions.append(np.copy(variable))
+            velocities.append(np.copy(constant))
+        spaces.append(interaction)
+
+    positions.append(np.zeros(2))
+    velocities.append(np.zeros(2))
+    masses.append(central_mass)
+    spaces.append(0)
+
+    return np.array(positions), np.array(velocities), np.array(masses, dtype=float), np.array(spaces)
+
+
+# Advances M independent systems of N objects together as stacked (M, N, 2) arrays,
+# using the same solving methods as a single system
+class Ensemble:
+    def __init__(self, positions, velocities, masses, spaces, mappings, solver="rk4", softening=0):
+        self.positions = np.array(positions, dtype=float)
+        self.velocities = np.array(velocities, dtype=float)
+        self.masses = np.array(masses, dtype=float)
+        self.spaces = np.array(spaces)
+        self.coefficients, self.powers = np.array(mappings, dtype=float).T
+        self.solver = make_solver(solver)
+        self.softening = softening
+        self.time = 0
+
+    # Every member set up at random the way the gui does, with its own mapping
+    @classmethod
+    def random(cls, mappings, num_of_objects, on_pos=True, random_mass=True, interacting=True,
+               central_mass=10000, solver="rk4", softening=0):
+        setups = [random_setup(num_of_objects, on_pos, random_mass, interacting, central_mass) for _ in mappings]
+        return cls(*[np.stack(arrays) for arrays in zip(*setups)], mappings, solver, softening)
+
+    def total_forces(self, x):
+        return forces(x, x, self.masses, self.spaces, (self.coefficients, self.powers), softening=self.softening)
+
+    def step(self, dt, steps=1):
+        for i in range(steps):
+            self.positions, self.velocities, self.time = self.solver(self.positions, self.velocities, self.time,
+                                                                     self.total_forces, self.masses[..., None], dt)
+        return self.positions
+
+
 # Object Class
 class Object:
-    # Declare initial conditions
-    def __init__(self, ini_pos, ini_vel, mass, interaction_space=0):
-        self.positions = np.array([np.copy(ini_pos)])
+    # Declare initial conditions, the trail keeps the last positions for drawing. The full
+    # run is written to disk by the simulation's TrajectoryWriter when it is recorded
+    def __init__(self, ini_pos, ini_vel, mass, interaction_space=0, trail=50):
+        self.trail = Trail(trail, len(ini_pos))
         self.position = np.copy(ini_pos)
         self.pre_position = np.copy(ini_pos)
         self.velocity = np.copy(ini_vel)
@@ -57,26 +651,44 @@ class Object:
 
         self.ini_pos = np.copy(ini_pos)
         self.ini_vel = np.copy(ini_vel)
+        self.store(self.position)
+
+    # The kept positions, the last ones of the trail
+    @property
+    def positions(self):
+        return self.trail.array()
+
+    # Add the current position to the trail
+    def store(self, position):
+        self.trail.append(position)
 
     # Solve using euler method
     def euler_solved(self, T, F, dt):
         self.position, self.velocity, _ = euler_solving(self.position, self.velocity, T, F, self.mass, dt)
-        self.positions = np.vstack([self.positions, self.position])
+        self.store(self.position)
 
-        return self.positions
+        return self.trail.array()
 
     # Solve using leap frog
     def leap_frog_solved(self, T, F, dt):
         self.position, self.velocity, _ = leap_frog_solving(self.position, self.velocity, T, F, self.mass, dt)
-        self.positions = np.vstack([self.positions, self.position])
+        self.store(self.position)
 
-        return self.positions
+        return self.trail.array()
+
+    # Record a position found by the system
+    def record(self, position):
+        self.position = np.copy(position)
+        self.store(self.position)
+
+        return self.trail.array()
 
     # Reset Position
     def reset(self):
         self.position = np.copy(self.ini_pos)
         self.velocity = np.copy(self.ini_vel)
-        self.positions = np.array([np.copy(self.ini_pos)])
+        self.trail.clear()
+        self.store(self.position)
 
     # Update to new position
     def update(self):
@@ -94,13 +706,295 @@ class Object:
             return 0
 
 
+# A .npy file that grows along its first axis. The header is padded to a fixed size so it can
+# be rewritten with the new length after every chunk, and the file is always a valid .npy
+class AppendableNpy:
+    header_size = 128
+
+    def __init__(self, path, frame_shape):
+        self.path = path
+        self.frame_shape = tuple(frame_shape)
+        self.length = 0
+        self.file = open(path, "wb+")
+        self.write_header()
+
+    def write_header(self):
+        header = repr({"descr": "<f8", "fortran_order": False, "shape": (self.length, *self.frame_shape)})
+        header = header.encode("latin1")
+        if len(header) > self.header_size - 11:
+            raise ValueError(f"The .npy header of shape {(self.length, *self.frame_shape)} does not fit in "
+                             f"{self.header_size} bytes")
+        header = header.ljust(self.header_size - 11) + b"\n"
+        self.file.seek(0)
+        self.file.write(b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header)
+
+    def append(self, frames):
+        frames = np.ascontiguousarray(frames, dtype="<f8")
+        self.file.seek(0, 2)
+        self.file.write(frames.tobytes())
+        self.length += len(frames)
+        self.write_header()
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+# Streams the positions of a simulation to disk every stride steps. Frames are gathered in a
+# preallocated chunk and appended to path (frames, N, 2) and its .times.npy companion
+class TrajectoryWriter:
+    def __init__(self, path, count, stride=1, chunk=256):
+        self.stride = stride
+        self.chunk = chunk
+        self.positions = AppendableNpy(path, (count, 2))
+        self.times = AppendableNpy(times_path(path), ())
+        self.frames = np.zeros((chunk, count, 2))
+        self.frame_times = np.zeros(chunk)
+        self.size = 0
+
+    def record(self, step, time, positions):
+        if step % self.stride:
+            return
+        self.frames[self.size] = positions
+        self.frame_times[self.size] = time
+        self.size += 1
+        if self.size == self.chunk:
+            self.flush()
+
+    def flush(self):
+        if self.size:
+            self.positions.append(self.frames[:self.size])
+            self.times.append(self.frame_times[:self.size])
+            self.size = 0
+
+    def close(self):
+        self.flush()
+        self.positions.close()
+        self.times.close()
+
+
+def times_path(path):
+    return path[:-4] + ".times.npy" if path.endswith(".npy") else path + ".times.npy"
+
+
+# Memory map a recorded trajectory, only the frames that are used are ever read from disk
+def load_trajectory(path, start=None, stop=None, stride=None):
+    window = slice(start, stop, stride)
+    return np.load(times_path(path), mmap_mode="r")[window], np.load(path, mmap_mode="r")[window]
+
+
+# Animate any time window of a recorded trajectory without simulating it again
+def replay(path, start=None, stop=None, stride=None, trail=50):
+    times, positions = load_trajectory(path, start, stop, stride)
+
+    fig, ax = plt.subplots()
+    ax.set(xlim=[-1000, 1000], ylim=[-1000, 1000])
+    lines = [ax.plot([], [])[0] for i in range(positions.shape[1])]
+    title = ax.set_title("")
+
+    def animate(frame):
+        window = np.asarray(positions[max(0, frame - trail + 1):frame + 1])
+        for i, line in enumerate(lines):
+            line.set_data(window[:, i, 0], window[:, i, 1])
+        title.set_text(f"t = {times[frame]:.3f}")
+        return lines
+
+    ani = animation.FuncAnimation(fig, animate, len(times), interval=0)
+    plt.grid("minor")
+    plt.show()
+
+
+# The physics of a system without any drawing, every object is advanced at once as arrays
+class Simulation:
+    def __init__(self, positions, velocities, masses, spaces, mapping=(10.0, -2.0), dt=0.01, solver="euler",
+                 theta=0, cutoff=None, softening=0, skin=None):
+        self.positions = np.array(positions, dtype=float)
+        self.velocities = np.array(velocities, dtype=float)
+        self.masses = np.array(masses, dtype=float)
+        self.spaces = np.array(spaces)
+        self.mapping = mapping
+        self.dt = dt
+        self.time = 0
+
+        # Opening angle of the Barnes-Hut approximation, direct summation when it is 0
+        self.theta = theta
+        self.solver = make_solver(solver) if isinstance(solver, str) else solver
+
+        # Short range force laws only sum the pairs of a neighbour list within the cutoff
+        self.softening = softening
+        self.cutoff = cutoff
+        self.neighbours = NeighbourList(cutoff, skin) if cutoff else None
+
+        # Conservation diagnostics are only taken when asked for, the step timings always are
+        self.diagnostics = None
+        self.profile = Profiler()
+
+        # Trajectories are only written when a recorder is given
+        self.recorder = None
+        self.steps = 0
+
+    # Gather the state of a set of objects
+    @classmethod
+    def from_objects(cls, objects, *args, **kwargs):
+        return cls([obj.position for obj in objects], [obj.velocity for obj in objects],
+                   [obj.mass for obj in objects], [obj.interaction_space for obj in objects], *args, **kwargs)
+
+    # The force on every object when the objects are at x, the sources move with the
+    # bodies within a step so the higher order methods keep their order
+    def total_forces(self, x):
+        start = time.perf_counter()
+        if self.neighbours is not None:
+            total = cutoff_forces(x, self.masses, self.mapping, self.neighbours.update(x, self.spaces), self.cutoff,
+                                  self.softening)
+        elif self.theta > 0 and self.mapping[1] < 0:
+            total = barnes_hut_forces(x, x, self.masses, self.spaces, self.mapping, self.theta, self.softening)
+        else:
+            total = forces(x, x, self.masses, self.spaces, self.mapping, softening=self.softening)
+        self.profile.add("forces", time.perf_counter() - start)
+        return total
+
+    # Total energy, the potential uses the same neighbour list or tree as the forces
+    def energy(self):
+        if self.neighbours is not None:
+            potential = cutoff_energy(self.positions, self.masses, self.mapping,
+                                      self.neighbours.update(self.positions, self.spaces), self.cutoff, self.softening)
+        elif self.theta > 0 and self.mapping[1] < 0:
+            potential = barnes_hut_energy(self.positions, self.masses, self.spaces, self.mapping, self.theta,
+                                          self.softening)
+        else:
+            potential = potential_energy(self.positions, self.masses, self.spaces, self.mapping,
+                                         softening=self.softening, cutoff=self.cutoff)
+        return kinetic_energy(self.velocities, self.masses) + potential
+
+    # Change the settings between steps, a kept acceleration is stale once the forces change.
+    # Diagnostics are taken every diagnostics steps, or not at all when it is None
+    def configure(self, mapping, dt, theta, softening, cutoff, tolerance=None, diagnostics=None):
+        if isinstance(self.solver, VerletSolving) and \
+                (mapping, theta, softening, cutoff) != (self.mapping, self.theta, self.softening, self.cutoff):
+            self.solver.reset()
+        self.mapping = mapping
+        self.dt = dt
+        self.theta = theta
+        self.softening = softening
+        if cutoff != self.cutoff:
+            self.cutoff = cutoff
+            self.neighbours = NeighbourList(cutoff) if cutoff else None
+        if tolerance is not None and isinstance(self.solver, AdaptiveSolving):
+            self.solver.tolerance = tolerance
+        if not diagnostics:
+            self.diagnostics = None
+        elif self.diagnostics is None or self.diagnostics.interval != diagnostics:
+            self.diagnostics = Diagnostics(diagnostics)
+
+    # Write the trajectory from now on, starting with the current state
+    def start_recording(self, recorder):
+        self.recorder = recorder
+        recorder.record(self.steps, self.time, self.positions)
+
+    # Advance every object by a number of steps with the solving method
+    def step(self, steps=1):
+        for i in range(steps):
+            start = time.perf_counter()
+            self.positions, self.velocities, self.time = self.solver(self.positions, self.velocities, self.time,
+                                                                     self.total_forces, self.masses[:, None], self.dt)
+            self.profile.add("step", time.perf_counter() - start)
+
+            if self.diagnostics is not None:
+                self.diagnostics.observe(self)
+            self.steps += 1
+            if self.recorder is not None:
+                self.recorder.record(self.steps, self.time, self.positions)
+        return self.positions
+
+    # Conservation drift and step timings as one line
+    def report(self):
+        line = self.profile.report()
+        if self.neighbours is not None:
+            line += f", {self.neighbours.builds} neighbour list builds, {len(self.neighbours.first)} pairs"
+        if self.diagnostics is not None:
+            line += ", " + ", ".join(f"{name} drift {value:.3e}" for name, value in self.diagnostics.drift().items())
+        return line
+
+
+# Two buffers, the writer fills the one not being shown and then swaps them. Every buffer has a
+# version that is odd while it is being written, a reader retries if the version changed while
+# copying, so neither side ever waits on a lock
+class DoubleBuffer:
+    def __init__(self, shape):
+        self.buffers = [np.zeros(shape), np.zeros(shape)]
+        self.versions = [0, 0]
+        self.front = 0
+        self.published = 0
+
+    def publish(self, data):
+        back = 1 - self.front
+        self.versions[back] += 1
+        self.buffers[back][:] = data
+        self.versions[back] += 1
+        self.front = back
+        self.published += 1
+
+    def read(self):
+        while True:
+            front = self.front
+            version = self.versions[front]
+            data = self.buffers[front].copy()
+            if version % 2 == 0 and version == self.versions[front]:
+                return data
+
+
+# Runs a simulation in a background thread, publishing the positions after every substeps steps.
+# The next substeps steps only start once the published positions are taken for a frame, so
+# every displayed frame is exactly substeps steps on from the last one
+class PhysicsWorker(threading.Thread):
+    def __init__(self, simulation, substeps=1):
+        super().__init__(daemon=True)
+        self.simulation = simulation
+        self.substeps = substeps
+        self.buffer = DoubleBuffer(simulation.positions.shape)
+        self.buffer.publish(simulation.positions)
+
+        self.running = threading.Event()
+        self.stopped = threading.Event()
+        self.consumed = threading.Event()
+
+        # Settings from the gui wait here until the worker is between steps
+        self.pending = None
+        self.lock = threading.Lock()
+
+    def configure(self, substeps, **settings):
+        with self.lock:
+            self.pending = (substeps, settings)
+
+    # The latest published positions, the worker may then go on with the next steps
+    def take(self):
+        positions = self.buffer.read()
+        self.consumed.set()
+        return positions
+
+    def run(self):
+        while not self.stopped.is_set():
+            if self.running.wait(0.05) and self.consumed.wait(0.05):
+                self.consumed.clear()
+                with self.lock:
+                    pending, self.pending = self.pending, None
+                if pending is not None:
+                    self.substeps, settings = pending
+                    self.simulation.configure(**settings)
+                self.simulation.step(self.substeps)
+                self.buffer.publish(self.simulation.positions)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
 # Defines the system
 class System:
     # Set the systems ininitial conditions
     def __init__(self, axis, window):
         self.objects = []
         self.dt = 0.01
-        self.forcing = None
         self.axis = axis
         self.lines = []
         self.circles = []
@@ -110,81 +1004,104 @@ class System:
         self.mapping = ()
         self.window = window
 
-    # Solve using euler method
-    def euler_solved(self):
-        for i, obj in enumerate(self.objects):
-            def forcing(x):
-                return sum([obj2.generate_force(x, obj.mass, self.mapping, obj.interaction_space)
-                               for obj2 in self.objects if obj2 != obj])
+        # Opening angle of the Barnes-Hut approximation, direct summation when it is 0
+        self.theta = 0
+        self.cutoff = None
+        self.softening = 0
+        self.solver = euler_solving
+        self.substeps = 1
+        self.simulation = None
+        self.worker = None
+        self.frames = 0
+        self.shown = 0
+        self.record = None
 
-            posHis = obj.euler_solved(self.time, forcing, self.dt)
-            # Only keep the last 50 positions in the trace
-            if len(posHis[:, 0]) > 50:
-                posHis = posHis[-50:, :]
+    # Gather the state of every object into a simulation
+    def build_arrays(self):
+        self.simulation = Simulation.from_objects(self.objects, self.mapping, self.dt, self.solver, self.theta,
+                                                  self.cutoff, self.softening)
 
-            self.lines[i].set_data(posHis[:, 0], posHis[:, 1])
-            self.circles[i].set_center(tuple(posHis[-1]))
+    # Restart the physics from the objects in a new background worker
+    def start_worker(self):
+        self.stop_worker()
+        self.build_arrays()
+        if self.record is not None:
+            path, stride = self.record
+            self.simulation.start_recording(TrajectoryWriter(path, len(self.objects), stride))
+        self.worker = PhysicsWorker(self.simulation, self.substeps)
 
-        for obj in self.objects:
-            obj.update()
+        # The objects already show the starting positions the worker publishes first
+        self.shown = self.worker.buffer.published
+        self.worker.consumed.set()
+        self.worker.start()
 
-    # Solve using leapfrog
-    def leap_frog_solved(self):
-        for i, obj in enumerate(self.objects):
-            def forcing(x):
-                return sum([obj2.generate_force(x, obj.proprieties, self.mapping, obj.interaction_space)
-                               for obj2 in self.objects if obj2 != obj])
+    def stop_worker(self):
+        if self.worker is not None:
+            self.worker.stop()
+            self.worker = None
+        if self.simulation is not None and self.simulation.recorder is not None:
+            self.simulation.recorder.close()
+            self.simulation.recorder = None
 
-            posHis = obj.leap_frog_solved(self.time, forcing, self.dt)
-            # Only keep the last 50 positions in the trace
-            if len(posHis[:, 0]) > 50:
-                posHis = posHis[-50:, :]
+    # Show the given positions of every object
+    def draw(self, positions):
+        start = time.perf_counter()
+        for i, obj in enumerate(self.objects):
+            # The trail only keeps the last 50 positions for the trace
+            posHis = obj.record(positions[i])
+            obj.update()
 
             self.lines[i].set_data(posHis[:, 0], posHis[:, 1])
             self.circles[i].set_center(tuple(posHis[-1]))
+        self.simulation.profile.add("render", time.perf_counter() - start)
 
-        for obj in self.objects:
-            obj.update()
+    # Advance every object at once with the given solving method, without the worker
+    def solved(self, method):
+        self.simulation.solver = method
+        self.draw(self.simulation.step())
+
+    # Solve using euler method
+    def euler_solved(self):
+        self.solved(euler_solving)
 
-    # Run the simulation
+    # Solve using leapfrog
+    def leap_frog_solved(self):
+        self.solved(leap_frog_solving)
+
+    # Run the simulation, the physics runs in the worker and every frame shows its latest positions
     def run_simulation(self, frame):
         event, values = self.window.read(1)
 
         # Close program if gui is closed
         if event == gui.WINDOW_CLOSED or values["CLOSE"]:
+            self.stop_worker()
             import sys; sys.exit(0)
 
+        # Define the mapping and timestep
+        self.mapping = (values["COEFFICIENT"], values["POWER"])
+        self.dt = values["TIMESTEP"]
+        self.theta = values["THETA"]
+        self.cutoff = values["CUTOFF"] or None
+        self.softening = values["SOFTENING"]
+        self.substeps = int(values["SUBSTEPS"])
+        self.record = (values["RECORD-PATH"], int(values["RECORD-STRIDE"])) if values["RECORD"] else None
+
         # Reset if needed
         if event == "RESET":
             for obj in self.objects:
                 obj.reset()
+            if len(self.objects):
+                self.start_worker()
 
         # If the simulation is started
         if values["STARTSIM"]:
             # And is the first time set it up
             if not self.window["OBJECT-NUM"].Disabled:
-                interaction = 1
-                if values["INTERACTION"]:
-                    interaction = 0
-
-                num_of_objects = int(values["OBJECT-NUM"])
-                constant = np.random.randn(2) * 100
-                on_pos = values[2]
-                for i in range(num_of_objects):
-                    variable = np.random.randn(2) * 100
-                    if values["MASS"]:
-                        mass = random.randrange(1, 1000) / 10.0
-                    else:
-                        mass = 1
-                    if on_pos:
-                        variable = (variable / (np.sum(variable ** 2) ** (1 / 2)) * 1000)
-                        self.objects.append(Object(np.copy(constant), np.copy(variable), mass, interaction))
-                    else:
-                        self.objects.append(Object(np.copy(variable), np.copy(constant), mass, interaction))
-
-                self.objects.append(Object(np.zeros(2), np.zeros(2), values["CMASS"], 0))
-
-                self.objects = np.array(self.objects)
+                positions, velocities, masses, spaces = random_setup(int(values["OBJECT-NUM"]), values[2],
+                                                                     values["MASS"], values["INTERACTION"],
+                                                                     values["CMASS"])
+                self.objects = np.array([Object(positions[i], velocities[i], masses[i], spaces[i])
+                                         for i in range(len(masses))])
 
                 self.lines = [self.axis.plot(obj.position)[0] for obj in self.objects]
                 self.circles = [plt.Circle(obj.position, self.axis.get_xlim()[1] / 70,
@@ -198,22 +1115,55 @@ class System:
                 self.window["MASS"].update(disabled=True)
                 self.window["CMASS"].update(disabled=True)
 
-                for i in range(4):
+                self.window["SOLVER"].update(disabled=True)
+                self.solver = make_solver(values["SOLVER"])
+                for i in range(2, 4):
                     self.window[i].update(disabled=True)
 
-            # Define the mapping and timestep
-            self.mapping = (values["COEFFICIENT"], values["POWER"])
-            self.dt = values["TIMESTEP"]
+                self.start_worker()
 
-            # Run correct simulation
-            if values["0"]:
-                self.euler_solved()
-            else:
-                self.leap_frog_solved()
+            # Hand the settings to the worker, it applies them between steps
+            self.worker.configure(self.substeps, mapping=self.mapping, dt=self.dt, theta=self.theta,
+                                  softening=self.softening, cutoff=self.cutoff, tolerance=10 ** values["TOLERANCE"],
+                                  diagnostics=10 if values["REPORT"] else None)
+            self.worker.running.set()
+
+            # Only draw positions that have not been shown yet
+            if self.worker.buffer.published != self.shown:
+                self.shown = self.worker.buffer.published
+                self.draw(self.worker.take())
+
+            # Print the diagnostics every 50 frames when asked for
+            self.frames += 1
+            if values["REPORT"] and self.frames % 50 == 0:
+                print(self.simulation.report())
+        elif self.worker is not None:
+            self.worker.running.clear()
         return self.lines
 
 
+# Run a system set up at random without the gui or a display
+def headless(num_of_objects=10, steps=1000, dt=0.01, mapping=(10.0, -2.0), solver="euler", theta=0,
+             on_pos=True, random_mass=True, interacting=True, central_mass=10000, record=None, stride=1,
+             cutoff=None, softening=0, skin=None, diagnostics=None):
+    simulation = Simulation(*random_setup(num_of_objects, on_pos, random_mass, interacting, central_mass),
+                            mapping, dt, solver, theta, cutoff, softening, skin)
+    if diagnostics:
+        simulation.diagnostics = Diagnostics(diagnostics)
+    if record is not None:
+        simulation.start_recording(TrajectoryWriter(record, len(simulation.masses), stride))
+
+    simulation.step(steps)
+
+    if simulation.recorder is not None:
+        simulation.recorder.close()
+    return simulation
+
+
 def simulation():
+    if gui is None:
+        raise ImportError("PySimpleGUI is needed for the gui, use --headless to run without it")
+
     # Set up the GUI
     layout = [
         [gui.Text("Simulator")],
@@ -225,14 +1175,21 @@ def simulation():
         [gui.Text("Force Proprieties:")],
         [gui.Column([[gui.Text("Coefficient: "), gui.Slider((-1000.0, 1000.0), 10.0, orientation="horizontal", key="COEFFICIENT")]
                     ,[gui.Text("Power: "), gui.Slider((-10.0, 10.0), -2.0, orientation="horizontal", key="POWER")]], key="PROPRIETIES")],
-        [gui.Text("Solving Method: "), gui.Radio("Euler Method", "SOLVER", default=True, key=0),
-         gui.Radio("Leapfrog", "SOLVER", default=False, key=1)],
+        [gui.Text("Solving Method: "), gui.Combo(list(SOLVERS), default_value="euler", readonly=True, key="SOLVER")],
+        [gui.Text("Adaptive tolerance (log10): "), gui.Slider((-12, -2), -6, orientation="horizontal", key="TOLERANCE")],
         [gui.Text("Simulation: "), gui.Radio("Same position, different velocities", "SIMULATION", default=True, key=2)],
         [gui.Radio("Different Position, same velocity", "SIMULATION", default=False, key=3)],
         [gui.Checkbox("Interacting particles", default=True, key="INTERACTION"),
          gui.Checkbox("Random Mass", default=True, key="MASS")],
+        [gui.Checkbox("Print diagnostics", default=False, key="REPORT")],
+        [gui.Checkbox("Record trajectory to: ", default=False, key="RECORD"), gui.Input("trajectory.npy", size=(20, 1), key="RECORD-PATH")],
+        [gui.Text("Record every: "), gui.Slider((1, 100), 1, 1, orientation="horizontal", key="RECORD-STRIDE")],
         [gui.HorizontalSeparator()],
         [gui.Text("Timestep: "), gui.Slider((0.0, 1), 0.01, resolution=0.01, orientation="horizontal", key="TIMESTEP")],
+        [gui.Text("Steps per frame: "), gui.Slider((1, 100), 1, 1, orientation="horizontal", key="SUBSTEPS")],
+        [gui.Text("Barnes-Hut angle (0 is exact): "), gui.Slider((0.0, 1.5), 0.0, resolution=0.05, orientation="horizontal", key="THETA")],
+        [gui.Text("Cutoff radius (0 is none): "), gui.Slider((0.0, 1000.0), 0.0, orientation="horizontal", key="CUTOFF")],
+        [gui.Text("Softening length: "), gui.Slider((0.0, 50.0), 0.0, orientation="horizontal", key="SOFTENING")],
         [gui.Text("Central Planet: ")],
         [gui.Text("Mass: "), gui.Slider((0.0, 10000.0), 10000, orientation="horizontal", key="CMASS")],
     ]
@@ -251,4 +1208,40 @@ def simulation():
     plt.show()
 
 # Run program
-simulation()
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Planetary system simulator")
+    parser.add_argument("--headless", action="store_true", help="run without the gui or a display")
+    parser.add_argument("--objects", type=int, default=10)
+    parser.add_argument("--steps", type=int, default=1000)
+    parser.add_argument("--dt", type=float, default=0.01)
+    parser.add_argument("--coefficient", type=float, default=10.0)
+    parser.add_argument("--power", type=float, default=-2.0)
+    parser.add_argument("--solver", choices=list(SOLVERS), default="euler")
+    parser.add_argument("--theta", type=float, default=0, help="Barnes-Hut opening angle, 0 is exact")
+    parser.add_argument("--cutoff", type=float, default=None, help="ignore pairs further apart than this")
+    parser.add_argument("--softening", type=float, default=0, help="softening length of the force law")
+    parser.add_argument("--skin", type=float, default=None, help="neighbour list skin, 0.2 cutoff by default")
+    parser.add_argument("--diagnostics", type=int, default=None,
+                        help="take the conservation diagnostics every this many steps")
+    parser.add_argument("--different-positions", action="store_true")
+    parser.add_argument("--record", default=None, help="write the trajectory to this .npy file")
+    parser.add_argument("--stride", type=int, default=1,
+                        help="steps between recorded frames, or recorded frames between replayed ones")
+    parser.add_argument("--replay", default=None, help="animate a recorded trajectory")
+    parser.add_argument("--start", type=int, default=None, help="first frame to replay")
+    parser.add_argument("--stop", type=int, default=None, help="frame to stop the replay at")
+    args = parser.parse_args()
+
+    if args.replay:
+        replay(args.replay, args.start, args.stop, args.stride)
+    elif args.headless:
+        start = time.perf_counter()
+        result = headless(args.objects, args.steps, args.dt, (args.coefficient, args.power), args.solver,
+                          args.theta, not args.different_positions, record=args.record, stride=args.stride,
+                          cutoff=args.cutoff, softening=args.softening, skin=args.skin,
+                          diagnostics=args.diagnostics)
+        print(f"{args.steps} steps of {len(result.masses)} objects in {time.perf_counter() - start:.3f}s, "
+              f"simulated time {result.time:.3f}")
+        print(result.report())
+    else:
+        simulation()
\ No newline at end of file